@@ -1,5 +1,8 @@
 VALID_EXTENSIONS_XLS = "xls"
 VALID_EXTENSIONS_XLSX = "xlsx"
+VALID_EXTENSIONS_CSV = "csv"
+VALID_EXTENSIONS_PARQUET = "parquet"
+ROW_PAIS = 'PAIS'
 ROW_PRE = 'PRE'
 ROW_MODULO = 'MODULO'
 ROW_DETALLE = 'DETALLE'
@@ -0,0 +1,18 @@
+"""
+gunicorn settings, read from the working directory when it starts. The
+command line and GUNICORN_CMD_ARGS (see the Dockerfile) set the rest.
+"""
+import os
+
+# Request threads of each worker, read at startup like main.WORKER_THREADS,
+# which sizes the database pool with it
+threads = int(os.getenv('WORKER_THREADS', 32))
+
+
+def post_worker_init(worker):
+    """
+    Start the sheets parse pool of each worker once it has loaded the app,
+    before its threads start. See main.start_parse_executor.
+    """
+    import main
+    main.start_parse_executor()
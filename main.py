@@ -1,13 +1,31 @@
 import enum
+import io
 import logging
 import os
 import jwt
 import json
+import hashlib
+import csv
+import itertools
+import tempfile
 import pandas as pd
 import pprint
 import requests
+import threading
+import time
+import uuid
+import zlib
+import math
+import multiprocessing
 import datetime as dt
-from flask import Flask, jsonify, abort, request
+import concurrent.futures
+from collections import OrderedDict
+import numpy as np
+import openpyxl
+from flask import Flask, jsonify, abort, request, stream_with_context, \
+    send_file
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from functools import wraps
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
@@ -54,6 +72,92 @@ EXCHANGE_CURRENCY_URL = f"https://{EXCHANGE_BASE_URL}currencies.json"
 EXCHANGE_STATE_URL =    f"https://{EXCHANGE_BASE_URL}usage.json?app_id={CURRENCY_ID}"
 EXCHANGE_RATE_URL =     f"https://{EXCHANGE_BASE_URL}latest.json?app_id={CURRENCY_ID}"
 
+# HTTP client used for the other uservices and openexchangerates
+DOWNSTREAM_CONNECT_TIMEOUT = float(os.getenv('DOWNSTREAM_CONNECT_TIMEOUT', 3))
+DOWNSTREAM_READ_TIMEOUT = float(os.getenv('DOWNSTREAM_READ_TIMEOUT', 30))
+DOWNSTREAM_POOL_SIZE = int(os.getenv('DOWNSTREAM_POOL_SIZE', 32))
+DOWNSTREAM_RETRIES = int(os.getenv('DOWNSTREAM_RETRIES', 2))
+DOWNSTREAM_BACKOFF = float(os.getenv('DOWNSTREAM_BACKOFF', 0.2))
+
+# Seconds a compiled price matrix is served before being reloaded from the
+# database. Uploads are picked up right away through PriceTableVersion, this
+# only bounds changes made to the tables by hand.
+PRICE_MATRIX_TTL = float(os.getenv('PRICE_MATRIX_TTL', 300))
+
+# Cache of estimate responses by canonical request and price table version
+ESTIMATES_CACHE_SIZE = int(os.getenv('ESTIMATES_CACHE_SIZE', 2048))
+ESTIMATES_CACHE_TTL = float(os.getenv('ESTIMATES_CACHE_TTL', 600))
+
+# Compiled price matrices of past price table versions, used to re-price
+# saved projects with the prices they had
+PRICE_VERSIONS_CACHE_SIZE = int(os.getenv('PRICE_VERSIONS_CACHE_SIZE', 64))
+
+# Concurrent requests to the spaces uservice and the seconds a request may
+# wait for all of its spaces.
+SPACES_FETCH_WORKERS = int(os.getenv('SPACES_FETCH_WORKERS', 16))
+SPACES_FETCH_DEADLINE = float(os.getenv('SPACES_FETCH_DEADLINE', 10))
+
+# Threads that run the I/O steps of the estimates (spaces, price matrix and
+# project weeks) concurrently.
+ESTIMATE_IO_WORKERS = int(os.getenv('ESTIMATE_IO_WORKERS', 32))
+
+# Request threads of each gunicorn worker, gunicorn.conf.py sets its threads
+# from the same variable
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 32))
+
+# Cache of space id -> PriceModule id
+SPACES_CACHE_SIZE = int(os.getenv('SPACES_CACHE_SIZE', 4096))
+SPACES_CACHE_TTL = float(os.getenv('SPACES_CACHE_TTL', 3600))
+
+# Cache of m2 -> project weeks answered by the times uservice
+WEEKS_CACHE_SIZE = int(os.getenv('WEEKS_CACHE_SIZE', 1024))
+WEEKS_CACHE_TTL = float(os.getenv('WEEKS_CACHE_TTL', 3600))
+
+# Times uservice circuit breaker: consecutive failures that open it, seconds
+# it stays open and read timeout of each call. While it's open, project
+# weeks are the last ones answered for the same m2 (kept WEEKS_FALLBACK_TTL
+# seconds) or WEEKS_ESTIMATE_BASE + m2 / WEEKS_ESTIMATE_M2_PER_WEEK.
+TIMES_FAILURE_THRESHOLD = int(os.getenv('TIMES_FAILURE_THRESHOLD', 3))
+TIMES_RESET_TIMEOUT = float(os.getenv('TIMES_RESET_TIMEOUT', 30))
+TIMES_READ_TIMEOUT = float(os.getenv('TIMES_READ_TIMEOUT', 5))
+WEEKS_FALLBACK_TTL = float(os.getenv('WEEKS_FALLBACK_TTL', 7 * 24 * 3600))
+WEEKS_ESTIMATE_BASE = float(os.getenv('WEEKS_ESTIMATE_BASE', 4))
+WEEKS_ESTIMATE_M2_PER_WEEK = float(os.getenv('WEEKS_ESTIMATE_M2_PER_WEEK', 100))
+
+# Threads that run upload jobs in the background of each worker
+UPLOAD_JOB_WORKERS = int(os.getenv('UPLOAD_JOB_WORKERS', 1))
+
+# Seconds after which a queued or running upload job is taken as lost: the
+# worker that had it was restarted before finishing it
+UPLOAD_JOB_TIMEOUT = float(os.getenv('UPLOAD_JOB_TIMEOUT', 3600))
+
+# Database connections of each worker. A request thread holds one for the
+# whole request, the estimate threads one per spaces or price matrix step,
+# and an upload job two (the import and its progress updates), so by
+# default every thread can get one without waiting.
+DB_POOL_SIZE = int(os.getenv(
+    'DB_POOL_SIZE',
+    WORKER_THREADS + ESTIMATE_IO_WORKERS + 2 * UPLOAD_JOB_WORKERS))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+
+# Processes of each worker that parse the sheets of an uploaded xlsx
+# workbook in parallel, 1 to parse them in the request thread. The pool is
+# started by gunicorn's post_worker_init hook, see gunicorn.conf.py. Every
+# worker keeps its own, idle between uploads, so the default is small.
+UPLOAD_PARSE_WORKERS = int(os.getenv('UPLOAD_PARSE_WORKERS', 2))
+
+# Price values read per query by the exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+
+# Reader of the CSV uploads, pyarrow's multithreaded one if it's installed.
+# Parquet uploads need pyarrow.
+try:
+    import pyarrow.parquet
+    CSV_ENGINE = os.getenv('CSV_ENGINE', 'pyarrow')
+except ImportError:
+    pyarrow = None
+    CSV_ENGINE = os.getenv('CSV_ENGINE', 'c')
+
 
 
 # Flask Configurations
@@ -64,7 +168,24 @@ app.logger.setLevel(logging.DEBUG)
 # SQL Alchemy Configurations
 app.config['SQLALCHEMY_DATABASE_URI'] = f"mysql://{DB_USER}:{DB_PASS}@{DB_IP}:{DB_PORT}/{DB_SCHEMA}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy whose MySQL engines have a pool of DB_POOL_SIZE connections
+    plus DB_MAX_OVERFLOW. Other backends, as the SQLite of the tests, keep
+    their own pool, which doesn't take these options.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Called on every engine creation, also when the URI is changed
+        if sa_url.get_backend_name() == 'mysql':
+            options.setdefault('pool_size', DB_POOL_SIZE)
+            options.setdefault('max_overflow', DB_MAX_OVERFLOW)
+        return super().apply_driver_hacks(app, sa_url, options)
+
+
+db = PooledSQLAlchemy(app)
 Base = declarative_base()
 
 # Swagger Configurations
@@ -370,10 +491,286 @@ class ExchangeRateTimeStamp(db.Model):
         return jsonify(self.to_dict())
 
 
+class PriceTableVersion(db.Model):
+    """
+    id: Identifier, there is only one row with index 1.
+    version: Last version published, increased every time prices or design
+    prices are uploaded or rolled back.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PriceSnapshot(db.Model):
+    """
+    version: PriceTableVersion that published the snapshot
+    country_id: PriceCountry of the snapshot
+    source: What published it: 'upload', 'design' or 'rollback'
+    data: zlib compressed JSON of the prices of the country, see encode
+    created_at: When it was published
+    Snapshots are never updated: the prices of a country at a version are
+    the ones of its snapshot with the highest version up to it.
+    """
+    version = db.Column(db.Integer, primary_key=True)
+    country_id = db.Column(
+        db.Integer,
+        db.ForeignKey('price_country.id'),
+        primary_key=True)
+    source = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.LargeBinary(length=2 ** 24 - 1), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.now)
+
+    @staticmethod
+    def encode(values, design_id, design):
+        """
+        values: (module_id, category_id, low, medium, high) of each PriceValue
+        design_id, design: See design_prices
+        """
+        return zlib.compress(json.dumps({
+            'values': [list(value) for value in values],
+            'design_id': design_id,
+            'design': list(design) if design is not None else None
+        }).encode('utf-8'))
+
+    def decode(self):
+        """
+        Returns (values, design_id, design), as given to encode.
+        """
+        data = json.loads(zlib.decompress(self.data).decode('utf-8'))
+        design = tuple(data['design']) if data['design'] is not None else None
+        return ([tuple(value) for value in data['values']], data['design_id'],
+                design)
+
+
+class PriceGenVersion(db.Model):
+    """
+    price_gen_id: PriceGen of a saved project
+    version: PriceTableVersion the project was priced with when it was saved
+    """
+    price_gen_id = db.Column(
+        db.Integer,
+        db.ForeignKey('price_gen.id'),
+        primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+
+class PriceUploadHash(db.Model):
+    """
+    kind: Upload the hash is of, 'prices' or 'design'
+    name: Country name of a sheet, or '' for the whole workbook
+    digest: sha256 of the last content applied
+    """
+    kind = db.Column(db.String(10), primary_key=True)
+    name = db.Column(db.String(100), primary_key=True)
+    digest = db.Column(db.String(64), nullable=False)
+
+
+class UploadJobStatus(enum.Enum):
+    """
+    queued: Waiting for a background worker
+    running: Being imported
+    done: Imported, the result has the upload response
+    failed: Not imported, the error has the reason
+    """
+
+    queued = "QUEUED"
+    running = "RUNNING"
+    done = "DONE"
+    failed = "FAILED"
+
+
+class PriceUploadJob(db.Model):
+    """
+    id: Job id
+    filename: Name of the uploaded file
+    status: UploadJobStatus value
+    dry_run: If the upload is a dry run
+    force: If unchanged sheets are applied too
+    replace: If the stored values missing in the sheets are removed
+    sheets_total: Number of sheets of the workbook, once it's parsed
+    sheets_processed: Number of sheets imported
+    rows_total: Number of rows of the workbook, once it's parsed
+    rows_processed: Number of rows imported
+    error: Error message of a failed job
+    result: JSON of the upload response of a done job
+    created_at: When the upload was received
+    finished_at: When the job was done or failed
+    """
+    id = db.Column(db.String(32), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(10), nullable=False,
+                       default=UploadJobStatus.queued.value)
+    dry_run = db.Column(db.Boolean, nullable=False, default=False)
+    force = db.Column(db.Boolean, nullable=False, default=False)
+    replace = db.Column(db.Boolean, nullable=False, default=False)
+    sheets_total = db.Column(db.Integer, nullable=True)
+    sheets_processed = db.Column(db.Integer, nullable=False, default=0)
+    rows_total = db.Column(db.Integer, nullable=True)
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        """
+        Convert to dictionary
+        """
+        obj_dict = {
+            'job_id': self.id,
+            'filename': self.filename,
+            'status': self.status,
+            'dry_run': self.dry_run,
+            'force': self.force,
+            'replace': self.replace,
+            'sheets_total': self.sheets_total,
+            'sheets_processed': self.sheets_processed,
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed,
+            'error': self.error,
+            'result': json.loads(self.result) if self.result else None,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+        return obj_dict
+
+
+UPLOAD_JOB_LOST = 'The job was lost, its worker was restarted'
+
+
+def is_stale_upload_job(job, now):
+    """
+    Whether an upload job is still queued or running UPLOAD_JOB_TIMEOUT after
+    it was created. Jobs only live in the executor of the worker that
+    received them, so nothing finishes them once it's restarted.
+    """
+    return job.status in (UploadJobStatus.queued.value,
+                          UploadJobStatus.running.value) and \
+        job.created_at < now - dt.timedelta(seconds=UPLOAD_JOB_TIMEOUT)
+
+
+def fail_stale_upload_jobs():
+    """
+    Mark as failed the stale upload jobs, on startup
+    """
+    now = dt.datetime.now()
+    PriceUploadJob.query.filter(
+        PriceUploadJob.status.in_([UploadJobStatus.queued.value,
+                                   UploadJobStatus.running.value]),
+        PriceUploadJob.created_at <
+        now - dt.timedelta(seconds=UPLOAD_JOB_TIMEOUT)) \
+        .update({'status': UploadJobStatus.failed.value,
+                 'error': UPLOAD_JOB_LOST,
+                 'finished_at': now}, synchronize_session=False)
+    db.session.commit()
+
+
 db.create_all()
+fail_stale_upload_jobs()
+if PriceTableVersion.query.get(1) is None:
+    try:
+        db.session.add(PriceTableVersion(id=1, version=0))
+        db.session.commit()
+    except SQLAlchemyError:
+        # Another worker created it first
+        db.session.rollback()
 db.session.commit()
 
 
+def get_price_table_version():
+    """
+    Current version of the price tables, shared by every worker.
+    """
+    price_table_version = PriceTableVersion.query.get(1)
+    if price_table_version is None:
+        return 0
+    return price_table_version.version
+
+
+def bump_price_table_version():
+    """
+    Advance the version of the price tables in the current transaction, which
+    keeps the row locked until it ends, so publications are serialized.
+    Returns the new version.
+    """
+    updated = PriceTableVersion.query \
+        .filter(PriceTableVersion.id == 1) \
+        .update({PriceTableVersion.version: PriceTableVersion.version + 1},
+                synchronize_session=False)
+    if not updated:
+        db.session.add(PriceTableVersion(id=1, version=1))
+        db.session.flush()
+    return db.session.query(PriceTableVersion.version) \
+        .filter(PriceTableVersion.id == 1) \
+        .scalar()
+
+
+def design_prices(price_design):
+    """
+    (PriceDesign id, (category_1, ..., category_5)) of a PriceDesign, or
+    (None, None).
+    """
+    if price_design is None:
+        return None, None
+    return price_design.id, (price_design.category_1, price_design.category_2,
+                             price_design.category_3, price_design.category_4,
+                             price_design.category_5)
+
+
+def snapshot_prices(country_id):
+    """
+    PriceSnapshot data of the PriceValues and PriceDesign of a country, as
+    they are in the current transaction.
+    """
+    values = db.session.query(PriceValue.module_id,
+                              PriceValue.category_id,
+                              PriceValue.low,
+                              PriceValue.medium,
+                              PriceValue.high) \
+        .filter(PriceValue.country_id == country_id) \
+        .all()
+    design_id, design = design_prices(PriceDesign.query.filter(
+        PriceDesign.country_id == country_id).first())
+    return PriceSnapshot.encode(values, design_id, design)
+
+
+def publish_price_version(country_ids, source):
+    """
+    Publish the prices of the given countries, as they are in the current
+    transaction, as a new PriceTableVersion and commit it. Countries without
+    any PriceSnapshot yet are published too, so every version has all of
+    them. Estimates keep reading the previous version until the commit.
+    source: PriceSnapshot source
+    Returns the new version.
+    """
+    db.session.flush()
+    version = bump_price_table_version()
+    country_ids = set(country_ids)
+    country_ids.update(
+        country_id for country_id, in db.session.query(PriceCountry.id)
+        .filter(~PriceCountry.id.in_(
+            db.session.query(PriceSnapshot.country_id))))
+    for country_id in country_ids:
+        db.session.add(PriceSnapshot(version=version, country_id=country_id,
+                                     source=source,
+                                     data=snapshot_prices(country_id)))
+    db.session.commit()
+    return version
+
+
+def get_price_snapshot(country_id, version=None):
+    """
+    PriceSnapshot of a country at a version, the latest one if version is
+    None. Returns None if the country has none.
+    """
+    query = PriceSnapshot.query.filter(PriceSnapshot.country_id == country_id)
+    if version is not None:
+        query = query.filter(PriceSnapshot.version <= version)
+    return query.order_by(PriceSnapshot.version.desc()).first()
+
+
 def token_required(f):
     @wraps(f)
     def decorator(*args, **kwargs):
@@ -406,26 +803,478 @@ def token_required(f):
     return decorator
 
 
+class DownstreamSession(requests.Session):
+    """
+    requests.Session for the calls to other services: keep-alive connection
+    pools per host, bounded retries with exponential backoff on connection
+    errors and 502/503/504, and a default (connect, read) timeout.
+    """
+
+    def __init__(self, timeout, pool_size, retries, backoff):
+        super().__init__()
+        self.timeout = timeout
+        # Every downstream call is idempotent, so all of them can be
+        # retried. The times uservice has its own session without retries.
+        retry = Retry(total=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'PUT', 'POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+downstream = DownstreamSession(
+    timeout=(DOWNSTREAM_CONNECT_TIMEOUT, DOWNSTREAM_READ_TIMEOUT),
+    pool_size=DOWNSTREAM_POOL_SIZE,
+    retries=DOWNSTREAM_RETRIES,
+    backoff=DOWNSTREAM_BACKOFF)
+
+
+# Returned by TTLCache.get when the key isn't cached.
+CACHE_MISS = object()
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache whose entries expire ttl seconds after being set.
+
+    maxsize: Max number of entries, the least recently used is evicted first
+    ttl: Seconds an entry is valid
+    hits: Lookups that found a valid entry
+    misses: Lookups that didn't
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def purge(self):
+        """
+        Remove every entry. Returns the number of entries removed.
+        """
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while.
+
+    failure_threshold: Consecutive failures that open the circuit
+    reset_timeout: Seconds the circuit stays open. After them a single call
+                   is let through (half open): its success closes the
+                   circuit, its failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        If the dependency may be called now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning('Circuit opened')
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+# m2 -> project weeks. Only m2 changes in the request to the times uservice.
+project_weeks_cache = TTLCache(WEEKS_CACHE_SIZE, WEEKS_CACHE_TTL)
+# m2 -> last project weeks answered, used while the times uservice fails.
+project_weeks_fallback = TTLCache(WEEKS_CACHE_SIZE, WEEKS_FALLBACK_TTL)
+times_circuit = CircuitBreaker(TIMES_FAILURE_THRESHOLD, TIMES_RESET_TIMEOUT)
+# Calls to the times uservice are not retried: a hung service would hold
+# each estimate for several read timeouts, the circuit decides instead.
+times_session = DownstreamSession(
+    timeout=(DOWNSTREAM_CONNECT_TIMEOUT, TIMES_READ_TIMEOUT),
+    pool_size=DOWNSTREAM_POOL_SIZE,
+    retries=0,
+    backoff=0)
+
+
+def estimate_project_weeks(m2):
+    """
+    Rough project weeks for m2, used when the times uservice can't answer.
+    """
+    return math.ceil(WEEKS_ESTIMATE_BASE + m2 / WEEKS_ESTIMATE_M2_PER_WEEK)
+
+
 def get_project_weeks(m2, token):
-    try:
-        headers = {'Authorization': token}
-        data = {
-            "adm_agility": "normal",
-            "client_agility": "normal",
-            "construction_mod": "const_adm",
-            "constructions_times": "daytime",
-            "demolitions": "no",
-            "m2": m2,
-            "mun_agility": "normal",
-            "procurement_process": "direct"
-        }
-        resp = requests.post(
-            f'{TIMES_URL}{TIMES_MODULE_API}', headers=headers, json=data)
-        resp_data = json.loads(resp.text)
-        return resp_data['weeks']
-    except Exception as exp:
-        logging.error(f"Error getting spaces {exp}")
-        return f"Error getting spaces {exp}", 500
+    """
+    Get the project weeks of a project of m2 square meters.
+
+    Returns (weeks, source). source is:
+    - 'times': answered by the times uservice (maybe cached)
+    - 'cache': the times uservice failed or its circuit is open, and weeks is
+      the last value it answered for m2
+    - 'estimate': as 'cache', but there is no previous value, so weeks comes
+      from estimate_project_weeks
+    """
+    weeks = project_weeks_cache.get(m2)
+    if weeks is not None:
+        return weeks, 'times'
+
+    if times_circuit.allow():
+        try:
+            weeks = request_project_weeks(m2, token)
+            times_circuit.success()
+            project_weeks_cache.set(m2, weeks)
+            project_weeks_fallback.set(m2, weeks)
+            return weeks, 'times'
+        except Exception as exp:
+            times_circuit.failure()
+            logging.error(f"Error getting project weeks {exp}")
+
+    weeks = project_weeks_fallback.get(m2)
+    if weeks is not None:
+        return weeks, 'cache'
+    return estimate_project_weeks(m2), 'estimate'
+
+
+def request_project_weeks(m2, token):
+    headers = {'Authorization': token}
+    data = {
+        "adm_agility": "normal",
+        "client_agility": "normal",
+        "construction_mod": "const_adm",
+        "constructions_times": "daytime",
+        "demolitions": "no",
+        "m2": m2,
+        "mun_agility": "normal",
+        "procurement_process": "direct"
+    }
+    resp = times_session.post(
+        f'{TIMES_URL}{TIMES_MODULE_API}', headers=headers, json=data)
+    if resp.status_code != 200:
+        raise Exception(f"Times module answered {resp.status_code}")
+    resp_data = json.loads(resp.text)
+    return resp_data['weeks']
+
+
+# Order of the price levels in the last axis of PriceMatrix.values. The
+# response names are the ones used by the frontend ("normal" is stored as
+# PriceValue.medium).
+PRICE_LEVELS = ('low', 'normal', 'high')
+PRICE_LEVEL_INDEX = {level: i for i, level in enumerate(PRICE_LEVELS)}
+
+
+class PriceMatrix:
+    """
+    Read-only compiled prices of a country at a PriceTableVersion.
+
+    values: float array indexed by (module row, category column, level).
+            Row BASE_ROW holds the base prices (PriceValue.module_id is NULL).
+            Missing prices are 0.
+    module_rows: PriceModule id -> row in values
+    category_columns: PriceCategory id -> column in values
+    subcategory_columns: PriceCategory id -> (ids, columns) of the
+                         subcategories that have prices in this country
+    design_id: PriceDesign id of the country, or None
+    design: PriceDesign values (category_1, ..., category_5), or None
+    version: PriceTableVersion the matrix was loaded for, or None
+    """
+    BASE_ROW = 0
+
+    def __init__(self, country_id, values, module_rows, category_columns,
+                 subcategory_columns, design_id=None, design=None,
+                 version=None):
+        self.country_id = country_id
+        self.values = values
+        self.module_rows = module_rows
+        self.category_columns = category_columns
+        self.subcategory_columns = subcategory_columns
+        self.design_id = design_id
+        self.design = design
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def load(cls, country, version=None, historic=False):
+        """
+        Build the matrix of a PriceCountry from its PriceSnapshot at version,
+        read with one query, so it's always a whole published version.
+        Countries never published are read from the price tables.
+        Subcategories come from the CategoryTree.
+        historic: If version is a past one. Its tree is the current one,
+                  categories are only ever added. Returns None if the country
+                  has no snapshot at that version.
+        """
+        snapshot = get_price_snapshot(country.id, version)
+        if snapshot is not None:
+            rows, design_id, design = snapshot.decode()
+        elif historic:
+            return None
+        else:
+            rows = db.session.query(PriceValue.module_id,
+                                    PriceValue.category_id,
+                                    PriceValue.low,
+                                    PriceValue.medium,
+                                    PriceValue.high) \
+                .filter(PriceValue.country_id == country.id) \
+                .all()
+            design_id, design = design_prices(PriceDesign.query.filter(
+                PriceDesign.country_id == country.id).first())
+
+        module_rows = {}
+        category_columns = {}
+        for module_id, category_id, _, _, _ in rows:
+            if module_id is not None and module_id not in module_rows:
+                module_rows[module_id] = len(module_rows) + 1
+            if category_id not in category_columns:
+                category_columns[category_id] = len(category_columns)
+
+        values = np.zeros((len(module_rows) + 1, len(category_columns),
+                           len(PRICE_LEVELS)))
+        for module_id, category_id, low, medium, high in rows:
+            row = cls.BASE_ROW if module_id is None else module_rows[module_id]
+            values[row, category_columns[category_id]] = (low, medium, high)
+        values.setflags(write=False)
+
+        tree = get_category_tree(None if historic else version)
+        subcategory_columns = {}
+        for parent_id, subcategories in tree.children.items():
+            ids = [subcategory['id'] for subcategory in subcategories
+                   if subcategory['id'] in category_columns]
+            if ids:
+                subcategory_columns[parent_id] = (
+                    ids, np.array([category_columns[i] for i in ids]))
+
+        return cls(country.id, values, module_rows, category_columns,
+                   subcategory_columns, design_id, design, version)
+
+    def expired(self, version=None):
+        """
+        If the matrix is too old or, when a version is given, was loaded for
+        another version.
+        """
+        if version is not None and version != self.version:
+            return True
+        return time.monotonic() - self.loaded_at > PRICE_MATRIX_TTL
+
+    def price(self, row, category_id, level):
+        """
+        Price of a category for a module row and a level ('low', 'normal'
+        or 'high'). Returns 0 if the category has no price in this country.
+        """
+        column = self.category_columns.get(category_id)
+        if column is None:
+            return 0.0
+        return float(self.values[row, column, PRICE_LEVEL_INDEX[level]])
+
+    def design_value(self, m2):
+        """
+        Design price for a project of m2 square meters, 0 if the country has
+        no design prices.
+        """
+        if self.design is None:
+            return 0.0
+        if m2 < 100:
+            return self.design[0]
+        elif 100 <= m2 < 500:
+            return self.design[1]
+        elif 500 <= m2 < 1000:
+            return self.design[2]
+        elif 1000 <= m2 < 2500:
+            return self.design[3]
+        return self.design[4]
+
+
+class CategoryTree:
+    """
+    Read-only index of every PriceCategory.
+
+    by_id: PriceCategory id -> PriceCategory.to_dict()
+    by_name: PriceCategory name -> PriceCategory.to_dict() (lowest id wins)
+    children: PriceCategory id -> to_dict() of its subcategories, by id
+    version: PriceTableVersion the tree was loaded for, or None
+    """
+
+    def __init__(self, categories, version=None):
+        self.by_id = {}
+        self.by_name = {}
+        self.children = {}
+        for category_dict, parent_id in categories:
+            self.by_id[category_dict['id']] = category_dict
+            self.by_name.setdefault(category_dict['name'], category_dict)
+            if parent_id is not None:
+                self.children.setdefault(parent_id, []).append(category_dict)
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def load(cls, version=None):
+        categories = PriceCategory.query.order_by(PriceCategory.id).all()
+        return cls([(category.to_dict(), category.parent_category_id)
+                    for category in categories], version)
+
+    def expired(self, version=None):
+        if version is not None and version != self.version:
+            return True
+        return time.monotonic() - self.loaded_at > PRICE_MATRIX_TTL
+
+
+_category_tree = None
+_category_tree_lock = threading.Lock()
+
+
+def get_category_tree(version=None):
+    """
+    Get the CategoryTree, loading it if it's missing, expired or, when a
+    version is given, loaded for another PriceTableVersion.
+    """
+    global _category_tree
+    tree = _category_tree
+    if tree is not None and not tree.expired(version):
+        return tree
+
+    with _category_tree_lock:
+        if _category_tree is None or _category_tree.expired(version):
+            _category_tree = CategoryTree.load(version)
+        return _category_tree
+
+
+def invalidate_category_tree():
+    """
+    Drop the CategoryTree. Must be called after new categories are committed.
+    """
+    global _category_tree
+    _category_tree = None
+
+
+# Compiled price matrices by country name (upper case). Entries are only
+# replaced as a whole, so readers never see a half built matrix.
+_price_matrices = {}
+_price_matrices_lock = threading.Lock()
+
+# Matrices of past versions by (country name, version). Published versions
+# never change, they only expire to bound the memory.
+historic_price_matrices = TTLCache(PRICE_VERSIONS_CACHE_SIZE, PRICE_MATRIX_TTL)
+
+
+def get_price_matrix(country_name, version=None, historic=False):
+    """
+    Get the compiled PriceMatrix of a country, loading it if it's missing,
+    expired or, when a version is given, loaded for another
+    PriceTableVersion. Returns None if the country doesn't exist.
+    historic: If version is a past one, its matrix is kept apart from the
+              current ones. Returns None if the country had no prices then.
+    """
+    key = country_name.upper()
+    if historic:
+        matrix = historic_price_matrices.get((key, version), CACHE_MISS)
+        if matrix is CACHE_MISS:
+            country: PriceCountry = PriceCountry.query.filter(
+                PriceCountry.name == key).first()
+            matrix = PriceMatrix.load(country, version, historic=True) \
+                if country is not None else None
+            historic_price_matrices.set((key, version), matrix)
+        return matrix
+
+    matrix = _price_matrices.get(key)
+    if matrix is not None and not matrix.expired(version):
+        return matrix
+
+    with _price_matrices_lock:
+        matrix = _price_matrices.get(key)
+        if matrix is None or matrix.expired(version):
+            country: PriceCountry = PriceCountry.query.filter(
+                PriceCountry.name == key).first()
+            if country is None:
+                return None
+            matrix = PriceMatrix.load(country, version)
+            _price_matrices[key] = matrix
+    return matrix
+
+
+def reload_price_matrices(country_names, version=None):
+    """
+    Rebuild the matrices of the given countries and swap them in. Must be
+    called after the new prices are committed.
+    """
+    for country_name in country_names:
+        key = country_name.upper()
+        country: PriceCountry = PriceCountry.query.filter(
+            PriceCountry.name == key).first()
+        if country is None:
+            _price_matrices.pop(key, None)
+            continue
+        matrix = PriceMatrix.load(country, version)
+        with _price_matrices_lock:
+            _price_matrices[key] = matrix
 
 
 @app.route("/api/prices/spec", methods=['GET'])
@@ -441,104 +1290,446 @@ def spec():
     return jsonify(swag)
 
 
-@app.route('/api/prices/design/upload', methods=['POST'])
-@token_required
-def upload_design_prices():
+class SheetValidationError(ValueError):
     """
-        Upload/Update Design Prices
-        ---
-        tags:
-        - "Prices"
-        produces:
-        - "application/json"
-        consumes:
-        - "multipart/form-data"
-        parameters:
-        - name: "file"
-          in: "formData"
-          description: "File to upload"
-          required: true
-          type: file
+    A sheet has invalid data.
+    errors: Message of each problem found
     """
-    try:
-        ''' Verify that archive is a Excel spreadsheet (xls or xlsx)'''
-        # Check if the post request has the file part
-        if 'file' not in request.files:
-            abort(HTTPStatus.BAD_REQUEST, "No Multipart file found")
-        file = request.files['file']
-
-        if file.filename == '':
-            logging.warning('No selected File')
-            return jsonify({'message': "No selected file"}), HTTPStatus.BAD_REQUEST
-
-        filename: str = file.filename
-
-        filename_split: list = filename.split('.')
-        if not (filename_split[-1] == constants.VALID_EXTENSIONS_XLS or
-                filename_split[-1] == constants.VALID_EXTENSIONS_XLSX):
-            logging.warning(f'{filename_split[-1]} is not a valid extension')
-            return {
-                'message': f'{filename_split[-1]} is not a valid extension'}, 420
 
-        # Read sheets names as country name
+    def __init__(self, errors):
+        # errors is the only argument, so it survives the pickling back
+        # from the parse processes
+        super().__init__(errors)
+        self.errors = errors
 
-        if filename_split[-1] == constants.VALID_EXTENSIONS_XLSX:
-            sheets: dict = pd.read_excel(file.read(), None, engine='openpyxl')
-        else:
-            sheets: dict = pd.read_excel(file.read(), None)
+    def __str__(self):
+        return '; '.join(self.errors)
 
-        logging.debug(sheets)
 
-        country_design_prices = {}
+class SheetError(Exception):
+    """
+    Sheets of an uploaded workbook can't be parsed.
+    errors: Messages of each sheet that can't be parsed, by sheet name
+    """
 
-        # For Each sheet
-        for country_name in sheets:
-            try:
-                # If country exist take id, else, create a new country and take the
-                # new id
-                country: PriceCountry = PriceCountry.query \
-                    .filter(PriceCountry.name == country_name.upper()) \
-                    .first()
+    def __init__(self, failures):
+        """
+        failures: Exception of each sheet that can't be parsed, by sheet name
+        """
+        self.errors = {
+            sheet_name: exp.errors if isinstance(exp, SheetValidationError)
+            else [str(exp)]
+            for sheet_name, exp in failures.items()}
+        super().__init__('; '.join(
+            f'{sheet_name}: {"; ".join(errors)}'
+            for sheet_name, errors in self.errors.items()))
 
-                country_id: int
-                if country is None:
-                    country = PriceCountry()
-                    country.name = country_name.upper()
-                    country.code = country_name.upper()
-                    db.session.add(country)
-                    db.session.commit()
 
-                country_id = country.id
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
 
-            except Exception as exp:
-                logging.error(f"Error in database {exp}")
-                db.session.rollback()
-                return jsonify({'message': f"Error in database {exp}"}), 500
 
-            if country_id not in country_design_prices:
-                country_design_prices[country_id] = []
+def start_parse_executor():
+    """
+    Start the process pool that parses workbook sheets. Its processes are
+    forked, so they don't import the app again, and all of them at once:
+    call it before the process starts any thread, as forking a threaded
+    process can leave locks held forever in the children. Without a pool
+    the sheets are parsed in the request thread.
+    """
+    global _parse_executor
+    if UPLOAD_PARSE_WORKERS < 2 or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        return
+    # The children don't inherit the connections of the database pool
+    db.engine.dispose()
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=UPLOAD_PARSE_WORKERS,
+        mp_context=multiprocessing.get_context('fork'))
+    # Fork every process now, the first task starts them
+    executor.submit(int).result()
+    with _parse_executor_lock:
+        _parse_executor = executor
+
+
+def read_sheet(content, sheet_name, columns=None):
+    """
+    DataFrame of a sheet of an xlsx workbook, the first row being the
+    header. The sheet is streamed one row at a time with openpyxl's
+    read-only mode, keeping only the cells of the given columns, and empty
+    rows are skipped. Rows are indexed by their number in the sheet.
+    columns: Names of the columns to keep, None for all of them
+    """
+    workbook = openpyxl.load_workbook(
+        io.BytesIO(content), read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows, ())
+        names = [str(name) if name is not None else f'Unnamed: {i}'
+                 for i, name in enumerate(header)]
+        keep = {}
+        for i, name in enumerate(names):
+            if (columns is None or name in columns) and name not in keep:
+                keep[name] = i
+        data = {name: [] for name in keep}
+        numbers = []
+        for number, row in enumerate(rows, 2):
+            if all(value is None for value in row):
+                continue
+            numbers.append(number)
+            for name, i in keep.items():
+                data[name].append(row[i] if i < len(row) else None)
+    finally:
+        workbook.close()
+    return pd.DataFrame(data, index=numbers)
+
+
+# Reader of each upload file extension: the pandas Excel engine of the
+# workbooks, or one of TABLE_ENGINES
+UPLOAD_ENGINES = {
+    constants.VALID_EXTENSIONS_XLS: None,
+    constants.VALID_EXTENSIONS_XLSX: 'openpyxl',
+    constants.VALID_EXTENSIONS_CSV: 'csv',
+    constants.VALID_EXTENSIONS_PARQUET: 'parquet'
+}
+
+# Engines of the uploads that are a single table, with the country of each
+# row in the PAIS column instead of a sheet per country
+TABLE_ENGINES = ('csv', 'parquet')
+
+
+def read_table(content, engine, columns=None):
+    """
+    DataFrames of a CSV or Parquet upload by country (PAIS column), in order
+    of first appearance. Only the given columns and PAIS are read, by a
+    columnar reader. Rows are indexed by their line in the file, the header
+    being line 1.
+    columns: Names of the columns to keep, None for all of them
+    """
+    if engine == 'parquet' and pyarrow is None:
+        raise ValueError('Parquet uploads need pyarrow')
+    if columns is not None:
+        columns = [constants.ROW_PAIS] + \
+            [column for column in columns if column != constants.ROW_PAIS]
+        # Missing columns are left for the validation of the sheets
+        if engine == 'csv':
+            header = pd.read_csv(io.BytesIO(content), nrows=0).columns
+        else:
+            header = pyarrow.parquet.read_schema(io.BytesIO(content)).names
+        columns = [column for column in columns if column in header]
+    if engine == 'csv':
+        table = pd.read_csv(io.BytesIO(content), engine=CSV_ENGINE,
+                            usecols=columns)
+    else:
+        table = pd.read_parquet(io.BytesIO(content), columns=columns)
+    # pyarrow reads the empty cells of text columns as '', not as missing
+    table = table.replace('', np.nan) \
+        .set_axis(pd.RangeIndex(2, len(table) + 2))
+
+    if constants.ROW_PAIS not in table.columns:
+        raise ValueError(f'{constants.ROW_PAIS} column not found')
+    countries = table[constants.ROW_PAIS]
+    if countries.isna().any():
+        raise ValueError(f'rows {list(countries.index[countries.isna()])} '
+                         f'have no {constants.ROW_PAIS}')
+    return {str(country_name): sheet.drop(columns=constants.ROW_PAIS)
+            for country_name, sheet in table.groupby(
+                countries.astype(str), sort=False)}
+
+
+def read_excel_sheets(content, engine, columns=None):
+    """
+    DataFrames of every sheet of a workbook read with pandas, by sheet name
+    in workbook order. xlrd loads the whole workbook to read any of its
+    sheets, so they are all read at once. As in read_sheet, empty rows are
+    skipped and rows are indexed by their number in the sheet.
+    columns: Names of the columns to keep, None for all of them
+    """
+    # Missing columns are left for the validation of the sheets
+    sheets = pd.read_excel(
+        io.BytesIO(content), None, engine=engine,
+        usecols=(lambda name: name in columns) if columns is not None
+        else None)
+    return {sheet_name: sheet.set_axis(pd.RangeIndex(2, len(sheet) + 2))
+            .dropna(how='all')
+            for sheet_name, sheet in sheets.items()}
 
-            for row in sheets[country_name].iterrows():
-                # Read Column B and finds out the price design category
-                try:
-                    design_category = row[1][1]
-                    price_design_category = float(row[1][2])
 
-                    country_design_prices[country_id].append(
-                        [design_category, price_design_category])
+def read_workbook_sheet(content, sheet_name, parse, columns=None):
+    """
+    Read one sheet of an xlsx workbook and parse it. Runs in the parse
+    processes.
+    """
+    return parse(read_sheet(content, sheet_name, columns))
 
-                except Exception as exp:
-                    msg = f"Error reading rows: {exp}"
-                    logging.error(msg)
-                    return jsonify({"message": msg}), 421
 
-            # Get a price design by PriceCountry. If Exist get Object else,
-            # create a new object. Update or create the values category_1,...,category_5.
+def workbook_sheet_names(content, engine):
+    """
+    Names of the sheets of a workbook, in order. For CSV and Parquet
+    uploads, the countries of its PAIS column.
+    """
+    if engine in TABLE_ENGINES:
+        return list(read_table(content, engine, []))
+    if engine != 'openpyxl':
+        return pd.ExcelFile(io.BytesIO(content), engine=engine).sheet_names
 
-            try:
-                qr = PriceDesign.query.filter(
-                    PriceDesign.country_id == country_id) .first()
-            except Exception as exp:
+    workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def read_workbook_sheets(content, engine, parse, columns=None):
+    """
+    Read and parse every sheet of a workbook. xlsx sheets are each read in
+    a process of the parse pool when there are several. Other workbooks are
+    read at once, and CSV and Parquet uploads as a whole to be parsed by
+    country (see read_table), both in this process.
+    content: Workbook file content
+    engine: pandas Excel engine, None for the default one, or one of
+            TABLE_ENGINES
+    parse: Function applied to the DataFrame of each sheet
+    columns: Names of the columns to read, None for all of them
+    Returns {sheet name: parse(sheet)} in workbook order. Every sheet is
+    parsed even if some fail, then SheetError is raised with all of their
+    errors.
+    """
+    failures = {}
+    if engine != 'openpyxl':
+        try:
+            tables = read_table(content, engine, columns) \
+                if engine in TABLE_ENGINES \
+                else read_excel_sheets(content, engine, columns)
+        except Exception as exp:
+            raise SheetError({engine or constants.VALID_EXTENSIONS_XLS: exp})
+        sheets = {}
+        for country_name, table in tables.items():
+            try:
+                sheets[country_name] = parse(table)
+            except Exception as exp:
+                failures[country_name] = exp
+        if failures:
+            raise SheetError(failures)
+        return sheets
+
+    global _parse_executor
+    sheet_names = workbook_sheet_names(content, engine)
+    executor = _parse_executor
+    if len(sheet_names) < 2 or executor is None:
+        sheets = {}
+        for sheet_name in sheet_names:
+            try:
+                sheets[sheet_name] = read_workbook_sheet(
+                    content, sheet_name, parse, columns)
+            except Exception as exp:
+                failures[sheet_name] = exp
+        if failures:
+            raise SheetError(failures)
+        return sheets
+
+    futures = {sheet_name: executor.submit(
+        read_workbook_sheet, content, sheet_name, parse, columns)
+        for sheet_name in sheet_names}
+    sheets = {}
+    for sheet_name, future in futures.items():
+        try:
+            sheets[sheet_name] = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # The next uploads are parsed in the request thread, a new pool
+            # can't be forked safely from this threaded process
+            with _parse_executor_lock:
+                if _parse_executor is executor:
+                    _parse_executor = None
+            raise
+        except Exception as exp:
+            failures[sheet_name] = exp
+    if failures:
+        raise SheetError(failures)
+    return sheets
+
+
+WORKBOOK_HASH_NAME = ''
+
+
+def get_upload_hashes(kind):
+    """
+    Digests of the last workbook and sheets applied by an upload kind, by
+    PriceUploadHash name.
+    """
+    return {upload_hash.name: upload_hash.digest for upload_hash in
+            PriceUploadHash.query.filter(PriceUploadHash.kind == kind)}
+
+
+def set_upload_hashes(kind, digests):
+    """
+    Store the digests of the workbook and sheets applied, in the current
+    transaction.
+    """
+    for name, digest in digests.items():
+        db.session.merge(PriceUploadHash(kind=kind, name=name, digest=digest))
+
+
+def workbook_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def sheet_digest(sheet):
+    """
+    Digest of a parsed sheet, a DataFrame or a JSON serializable value. It's
+    taken on the parsed values, which don't change when a workbook is saved
+    again or other sheets are edited.
+    """
+    if isinstance(sheet, pd.DataFrame):
+        data = pd.util.hash_pandas_object(sheet, index=False).values.tobytes()
+        data += json.dumps(list(sheet.columns)).encode('utf-8')
+    else:
+        data = json.dumps(sheet, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def upload_force():
+    """
+    If the upload request asks to apply the sheets even if they're unchanged.
+    """
+    return request.values.get('force', 'false').lower() in ('1', 'true')
+
+
+def upload_replace():
+    """
+    If the upload request asks to remove the stored values missing in the
+    sheets.
+    """
+    return request.values.get('replace', 'false').lower() in ('1', 'true')
+
+
+def parse_design_sheet(sheet):
+    """
+    [design category, price] of each row of a sheet of the design prices
+    workbook (columns B and C).
+    """
+    return [[row[1][1], float(row[1][2])] for row in sheet.iterrows()]
+
+
+# Columns of the CSV and Parquet design prices, besides PAIS
+DESIGN_TABLE_COLUMNS = ['CATEGORIA', 'VALOR']
+
+
+def parse_design_table(sheet):
+    """
+    [design category, price] of each row of a country of a CSV or Parquet
+    design prices upload (DESIGN_TABLE_COLUMNS).
+    """
+    missing = [column for column in DESIGN_TABLE_COLUMNS
+               if column not in sheet.columns]
+    if missing:
+        raise ValueError(f'columns {missing} not found')
+    category, value = DESIGN_TABLE_COLUMNS
+    return [[row[category], float(row[value])]
+            for _, row in sheet.iterrows()]
+
+
+@app.route('/api/prices/design/upload', methods=['POST'])
+@token_required
+def upload_design_prices():
+    """
+        Upload/Update Design Prices
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        consumes:
+        - "multipart/form-data"
+        parameters:
+        - name: "file"
+          in: "formData"
+          description: "File to upload"
+          required: true
+          type: file
+        - name: "force"
+          in: "query"
+          description: "If true, apply the sheets even if they're unchanged"
+          required: false
+          type: boolean
+    """
+    try:
+        ''' Verify that archive is a Excel spreadsheet (xls or xlsx), CSV
+        or Parquet'''
+        upload, error = read_upload_workbook()
+        if error is not None:
+            return error
+        _, content, engine = upload
+
+        # The same workbook as the last one applied is skipped unread
+        hashes = get_upload_hashes('design') if not upload_force() else {}
+        digest = workbook_digest(content)
+        if hashes.get(WORKBOOK_HASH_NAME) == digest:
+            return jsonify({'status': 'OK', 'applied': [], 'skipped': [
+                name.upper()
+                for name in workbook_sheet_names(content, engine)]})
+
+        # Read sheets names as country name
+        if engine in TABLE_ENGINES:
+            parse, columns = parse_design_table, DESIGN_TABLE_COLUMNS
+        else:
+            parse, columns = parse_design_sheet, None
+        try:
+            sheets: dict = read_workbook_sheets(content, engine, parse, columns)
+        except SheetError as exp:
+            msg = f"Error reading rows: {exp}"
+            logging.error(msg)
+            return jsonify({"message": msg, "errors": exp.errors}), 421
+
+        logging.debug('Design prices sheets read: %s', list(sheets))
+
+        country_design_prices = {}
+        applied = []
+        applied_ids = []
+        skipped = []
+
+        # For Each sheet
+        for country_name in sheets:
+            sheet_hash = sheet_digest(sheets[country_name])
+            if hashes.get(country_name.upper()) == sheet_hash:
+                skipped.append(country_name.upper())
+                continue
+            applied.append(country_name.upper())
+
+            try:
+                # If country exist take id, else, create a new country and take the
+                # new id
+                country: PriceCountry = PriceCountry.query \
+                    .filter(PriceCountry.name == country_name.upper()) \
+                    .first()
+
+                country_id: int
+                if country is None:
+                    country = PriceCountry()
+                    country.name = country_name.upper()
+                    country.code = country_name.upper()
+                    db.session.add(country)
+                    db.session.commit()
+
+                country_id = country.id
+                applied_ids.append(country_id)
+
+            except Exception as exp:
+                logging.error(f"Error in database {exp}")
+                db.session.rollback()
+                return jsonify({'message': f"Error in database {exp}"}), 500
+
+            if country_id not in country_design_prices:
+                country_design_prices[country_id] = []
+            country_design_prices[country_id].extend(sheets[country_name])
+
+            # Get a price design by PriceCountry. If Exist get Object else,
+            # create a new object. Update or create the values category_1,...,category_5.
+
+            try:
+                qr = PriceDesign.query.filter(
+                    PriceDesign.country_id == country_id) .first()
+            except Exception as exp:
                 logging.error(f"Database error {exp}")
                 return jsonify({'message': f"Database error {exp}"}), 500
 
@@ -567,14 +1758,22 @@ def upload_design_prices():
 
             # commit database
             try:
+                set_upload_hashes('design', {country_name.upper(): sheet_hash})
                 db.session.commit()
             except Exception as exp:
                 db.session.rollback()
                 logging.error(f"Database error {exp}")
                 return jsonify({'message': f"Database error {exp}"}), 500
 
+        set_upload_hashes('design', {WORKBOOK_HASH_NAME: digest})
+        if applied:
+            reload_price_matrices(
+                applied, publish_price_version(applied_ids, 'design'))
+        else:
+            db.session.commit()
+
         # Return status
-        return jsonify({'status': 'OK'})
+        return jsonify({'status': 'OK', 'applied': applied, 'skipped': skipped})
     except SQLAlchemyError as e:
         return f'Database error  f{e}', 500
     except XLRDError as exc:
@@ -584,6 +1783,341 @@ def upload_design_prices():
         return jsonify({'message': exp}), 500
 
 
+PRICE_SHEET_LEVELS = ('low', 'medium', 'high')
+
+# Columns of the prices sheets, the rest are not read
+PRICE_SHEET_COLUMNS = [
+    constants.ROW_PRE, constants.ROW_MODULO, constants.ROW_PARAMETRO,
+    constants.ROW_DETALLE, constants.ROW_BAJO, constants.ROW_MEDIO,
+    constants.ROW_ALTO]
+
+
+# Rows listed by each validation message
+MAX_ERROR_ROWS = 20
+
+
+def validate_prices_sheet(sheet):
+    """
+    Problems of a sheet of the prices workbook, checked on whole columns
+    before it's parsed: missing columns, prices that aren't numbers, rows
+    without category or module, category names whose parentheses (the
+    marker of type 'B') don't close and rows repeated for the same module,
+    category and detail. Rows are numbered by the index of the sheet,
+    which the readers set to the row number in the file.
+    Returns the message of each problem, none if the sheet is valid.
+    """
+    missing = [column for column in PRICE_SHEET_COLUMNS
+               if column not in sheet.columns]
+    if missing:
+        return [f'columns {missing} not found']
+
+    def rows(mask):
+        numbers = [int(i) for i in sheet.index[mask][:MAX_ERROR_ROWS]]
+        if mask.sum() > MAX_ERROR_ROWS:
+            return f'{numbers} and {mask.sum() - MAX_ERROR_ROWS} more'
+        return numbers
+
+    errors = []
+    is_base = sheet[constants.ROW_PRE] == 'BASE'
+    category = sheet[constants.ROW_MODULO].where(
+        is_base, sheet[constants.ROW_PARAMETRO])
+    no_category = category.isna()
+    if no_category.any():
+        errors.append(f'rows {rows(no_category)} have no category')
+    no_module = sheet[constants.ROW_MODULO].isna() & ~is_base
+    if no_module.any():
+        errors.append(f'rows {rows(no_module)} have no module')
+
+    for column in (constants.ROW_BAJO, constants.ROW_MEDIO, constants.ROW_ALTO):
+        not_number = pd.to_numeric(sheet[column], errors='coerce').isna() & \
+            sheet[column].notna()
+        if not_number.any():
+            errors.append(f'{column} of rows {rows(not_number)} '
+                          f'is not a number')
+
+    names = category.astype(str)
+    unclosed = ~no_category & \
+        (names.str.count(r'\(') != names.str.count(r'\)'))
+    if unclosed.any():
+        errors.append(f'categories {sorted(set(names[unclosed]))} of rows '
+                      f'{rows(unclosed)} have unclosed parentheses')
+
+    keys = pd.DataFrame({
+        'module': sheet[constants.ROW_MODULO].where(~is_base),
+        'category': category,
+        'detail': sheet[constants.ROW_DETALLE]})
+    repeated = keys.duplicated(keep=False) & ~no_category
+    if repeated.any():
+        errors.append(f'rows {rows(repeated)} repeat the same module, '
+                      f'category and detail')
+    return errors
+
+
+def parse_prices_sheet(sheet):
+    """
+    Typed columns of a sheet of the prices workbook, one row per sheet row,
+    raising SheetValidationError with every problem validate_prices_sheet
+    finds:
+    is_base: If the row is a base cost (PRE is 'BASE'), without module
+    module: PriceModule name, None for base costs
+    category: PriceCategory name (MODULO for base costs, else PARAMETRO)
+    subcategory: Subcategory name (DETALLE), None if the row has no detail
+    type: 'B' if the category name has a parenthesis, else 'A'
+    low, medium, high: Prices, 0 if empty
+    """
+    errors = validate_prices_sheet(sheet)
+    if errors:
+        raise SheetValidationError(errors)
+
+    is_base = sheet[constants.ROW_PRE] == 'BASE'
+    category = sheet[constants.ROW_MODULO].where(
+        is_base, sheet[constants.ROW_PARAMETRO]).astype(str)
+    module = sheet[constants.ROW_MODULO].astype(object)
+    subcategory = sheet[constants.ROW_DETALLE].astype(object)
+
+    return pd.DataFrame({
+        'is_base': is_base,
+        'module': module.where(~is_base, None),
+        'category': category,
+        'subcategory': subcategory.where(subcategory.notna(), None),
+        'type': np.where(category.str.contains('(', regex=False), 'B', 'A'),
+        'low': pd.to_numeric(sheet[constants.ROW_BAJO]).fillna(0),
+        'medium': pd.to_numeric(sheet[constants.ROW_MEDIO]).fillna(0),
+        'high': pd.to_numeric(sheet[constants.ROW_ALTO]).fillna(0)
+    })
+
+
+class PriceImportIndex:
+    """
+    Existing rows an upload resolves its sheets against, loaded once per
+    upload so every row is looked up in memory. Rows created while importing
+    are added to the indexes.
+    countries: PriceCountry by name
+    modules: PriceModule by name
+    categories: PriceCategory by (parent_category_id, name), None as parent
+    for top level categories
+    values: (PriceValue id, (low, medium, high)) by (country_id, module_id,
+    category_id)
+    created_modules: Number of modules created
+    created_categories: Number of categories and subcategories created
+    """
+
+    def __init__(self, country_names):
+        # Lowest id wins when names are repeated
+        self.countries = {
+            country.name: country for country in PriceCountry.query
+            .filter(PriceCountry.name.in_({name.upper()
+                                           for name in country_names}))
+            .order_by(PriceCountry.id.desc())}
+        self.modules = {
+            module.name: module for module in
+            PriceModule.query.order_by(PriceModule.id.desc())}
+        self.categories = {
+            (category.parent_category_id, category.name): category
+            for category in
+            PriceCategory.query.order_by(PriceCategory.id.desc())}
+        self.values = {}
+        if self.countries:
+            country_ids = [country.id for country in self.countries.values()]
+            for value_id, country_id, module_id, category_id, *levels in \
+                    db.session.query(PriceValue.id, PriceValue.country_id,
+                                     PriceValue.module_id,
+                                     PriceValue.category_id, PriceValue.low,
+                                     PriceValue.medium, PriceValue.high) \
+                    .filter(PriceValue.country_id.in_(country_ids)) \
+                    .order_by(PriceValue.id.desc()):
+                self.values[(country_id, module_id, category_id)] = \
+                    (value_id, tuple(levels))
+        self.created_modules = 0
+        self.created_categories = 0
+
+    def country(self, country_name):
+        """
+        Get the PriceCountry of a sheet, creating it if it's missing.
+        """
+        name = country_name.upper()
+        if name not in self.countries:
+            country = PriceCountry()
+            country.name = name
+            country.code = name
+            db.session.add(country)
+            db.session.flush()
+            self.countries[name] = country
+        return self.countries[name]
+
+    def add_modules(self, modules):
+        """
+        Add the new PriceModules in one flush.
+        """
+        if modules:
+            db.session.add_all(modules)
+            db.session.flush()
+            self.modules.update((module.name, module) for module in modules)
+            self.created_modules += len(modules)
+
+    def add_categories(self, categories):
+        """
+        Add the new PriceCategories in one flush.
+        """
+        if categories:
+            db.session.add_all(categories)
+            db.session.flush()
+            self.categories.update(
+                ((category.parent_category_id, category.name), category)
+                for category in categories)
+            self.created_categories += len(categories)
+
+
+def same_prices(old, new):
+    """
+    If two (low, medium, high) are equal, give or take the precision of
+    the database floats.
+    """
+    return all(math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-9)
+               for a, b in zip(old, new))
+
+
+def write_price_values(country_id, values, stored, replace=False):
+    """
+    Write the prices of a country, diffing them with the stored ones: only
+    new and changed values are written, with bulk inserts and updates. If
+    replace is set, the stored values missing in values are deleted, unless
+    saved projects use them. Nothing is committed.
+    values: (low, medium, high) by (module_id, category_id)
+    stored: (PriceValue id, (low, medium, high)) by (module_id, category_id)
+
+    Returns the number of values 'inserted', 'changed', 'removed', 'kept'
+    (missing in values but used by saved projects) and 'unchanged', and
+    'rows' with the (module_id, category_id, old, new) of each value written.
+    """
+    result = {'inserted': 0, 'changed': 0, 'removed': 0, 'kept': 0,
+              'unchanged': 0, 'rows': []}
+    inserts = []
+    updates = []
+    for (module_id, category_id), levels in values.items():
+        levels = tuple(map(float, levels))
+        mapping = dict(zip(PRICE_SHEET_LEVELS, levels))
+        value_id, old = stored.get((module_id, category_id), (None, None))
+        if value_id is None:
+            mapping.update(country_id=country_id, module_id=module_id,
+                           category_id=category_id)
+            inserts.append(mapping)
+            result['inserted'] += 1
+        elif not same_prices(old, levels):
+            mapping['id'] = value_id
+            updates.append(mapping)
+            result['changed'] += 1
+        else:
+            result['unchanged'] += 1
+            continue
+        result['rows'].append((module_id, category_id, old, levels))
+
+    removed = {value_id: (module_id, category_id, old)
+               for (module_id, category_id), (value_id, old) in stored.items()
+               if replace and (module_id, category_id) not in values}
+    if removed:
+        used = {value_id for value_id, in db.session.query(
+            PriceGenHasPriceValue.price_value_id).filter(
+            PriceGenHasPriceValue.price_value_id.in_(removed)).distinct()}
+        result['kept'] = len(used)
+        for value_id in used:
+            del removed[value_id]
+        for module_id, category_id, old in removed.values():
+            result['rows'].append((module_id, category_id, old, None))
+        result['removed'] = len(removed)
+
+    db.session.bulk_update_mappings(PriceValue, updates)
+    db.session.bulk_insert_mappings(PriceValue, inserts)
+    if removed:
+        PriceValue.query.filter(PriceValue.id.in_(removed)) \
+            .delete(synchronize_session=False)
+    return result
+
+
+def import_prices_sheet(country_name, price_sheet, index, replace=False):
+    """
+    Apply a sheet parsed by parse_prices_sheet as the prices of its country,
+    creating the country, modules and categories it's missing. Rows are
+    resolved against the PriceImportIndex of the upload and written with
+    write_price_values, which removes the values missing in the sheet only
+    if replace is set. Nothing is committed.
+    Each row sets the value of its (module, subcategory), and the value of
+    its (module, category) is the sum of all the rows of the category.
+
+    Returns the diff: number of values 'inserted', 'changed', 'removed',
+    'kept' (missing in the sheet but used by saved projects) and
+    'unchanged', and 'rows' with the module, category, parent category, old
+    and new (low, medium, high) of each written value.
+    """
+    country = index.country(country_name)
+
+    # Modules
+    index.add_modules([PriceModule(name=name)
+                       for name in set(price_sheet['module'].dropna())
+                       if name not in index.modules])
+
+    # Categories, each one takes its code and type from its first row
+    first_rows = price_sheet.drop_duplicates('category')
+    index.add_categories([
+        PriceCategory(name=row.category, type=row.type,
+                      code='BASE' if row.is_base else row.category)
+        for row in first_rows.itertuples()
+        if (None, row.category) not in index.categories])
+    categories = {row.category: index.categories[(None, row.category)]
+                  for row in first_rows.itertuples()}
+
+    # Subcategories
+    detail_rows = price_sheet[price_sheet['subcategory'].notna()] \
+        .drop_duplicates(['category', 'subcategory'])
+    index.add_categories([
+        PriceCategory(
+            name=row.subcategory, type=row.type,
+            code='BASE' if row.is_base else f'{row.category} {row.subcategory}',
+            parent_category_id=categories[row.category].id)
+        for row in detail_rows.itertuples()
+        if (categories[row.category].id, row.subcategory)
+        not in index.categories])
+
+    # Values by (module id, category id). Rows first, so the sums of the
+    # categories replace the rows without subcategory.
+    values = {}
+    for row in price_sheet.itertuples():
+        module_id = index.modules[row.module].id \
+            if row.module is not None else None
+        category_id = categories[row.category].id
+        if row.subcategory is not None:
+            category_id = index.categories[(category_id, row.subcategory)].id
+        values[(module_id, category_id)] = (row.low, row.medium, row.high)
+    sums = price_sheet.groupby(['module', 'category'], dropna=False, sort=False)[
+        list(PRICE_SHEET_LEVELS)].sum()
+    for (module_name, category_name), row in sums.iterrows():
+        module_id = index.modules[module_name].id \
+            if pd.notna(module_name) else None
+        values[(module_id, categories[category_name].id)] = \
+            (row['low'], row['medium'], row['high'])
+
+    module_names = {module.id: name for name, module in index.modules.items()}
+    category_keys = {category.id: key
+                     for key, category in index.categories.items()}
+
+    def diff_row(module_id, category_id, old, new):
+        parent_id, name = category_keys[category_id]
+        return {
+            'module': module_names.get(module_id),
+            'category': name,
+            'parent': category_keys[parent_id][1] if parent_id else None,
+            'old': list(old) if old is not None else None,
+            'new': list(new) if new is not None else None
+        }
+
+    stored = {(module_id, category_id): value
+              for (country_id, module_id, category_id), value
+              in index.values.items() if country_id == country.id}
+    diff = write_price_values(country.id, values, stored, replace)
+    diff['rows'] = [diff_row(*row) for row in diff['rows']]
+    return diff
+
+
 @app.route('/api/prices/upload', methods=['POST'])
 def upload_prices():
     """
@@ -598,12 +2132,47 @@ def upload_prices():
         parameters:
         - name: "file"
           in: "formData"
-          description: "File to upload"
+          description: "Workbook (xls or xlsx) with a sheet per country, or CSV or Parquet file with a PAIS column"
           required: true
           type: file
+        - name: "force"
+          in: "query"
+          description: "If true, apply the sheets even if they're unchanged"
+          required: false
+          type: boolean
+        - name: "replace"
+          in: "query"
+          description: "If true, remove the stored values of each country missing in its sheet"
+          required: false
+          type: boolean
+        - name: "dry_run"
+          in: "query"
+          description: "If true, return the diff without writing it"
+          required: false
+          type: boolean
+        responses:
+            200:
+              description: "{'status': 'OK', 'dry_run': bool, 'diff': {country: diff}} with the values inserted, changed and removed"
     """
 
-    ''' Verify that archive is a Excel spreadsheet (xls or xlsx)'''
+    workbook, error = read_upload_workbook()
+    if error is not None:
+        return error
+
+    filename, content, engine = workbook
+    resp, code = import_prices_workbook(
+        content, engine, upload_dry_run(), force=upload_force(),
+        replace=upload_replace())
+    return jsonify(resp), code
+
+
+def read_upload_workbook():
+    """
+    Read the Excel spreadsheet (xls or xlsx), CSV or Parquet file posted as
+    'file'.
+    Returns ((filename, content, UPLOAD_ENGINES engine), None) or (None, error
+    response).
+    """
     # Check if the post request has the file part
     if 'file' not in request.files:
         abort(HTTPStatus.BAD_REQUEST, "No Multipart file found")
@@ -611,290 +2180,602 @@ def upload_prices():
 
     if file.filename == '':
         logging.warning('No selected File')
-        return jsonify({'message': "No selected file"}), HTTPStatus.BAD_REQUEST
+        return None, (jsonify({'message': "No selected file"}),
+                      HTTPStatus.BAD_REQUEST)
 
     filename: str = file.filename
 
     filename_split: list = filename.split('.')
 
-    if not (filename_split[-1] == constants.VALID_EXTENSIONS_XLS or
-            filename_split[-1] == constants.VALID_EXTENSIONS_XLSX):
+    if filename_split[-1] not in UPLOAD_ENGINES:
         logging.warning(f'{filename_split[-1]} is not a valid extension')
-        return {
-            'message': f'{filename_split[-1]} is not a valid extension'}, 420
-
-    # Read sheets names as country name
-    if filename_split[-1] == constants.VALID_EXTENSIONS_XLSX:
-        sheets: dict = pd.read_excel(file.read(), None, engine='openpyxl')
-    else:
-        sheets: dict = pd.read_excel(file.read(), None)
+        return None, ({
+            'message': f'{filename_split[-1]} is not a valid extension'}, 420)
 
-    logging.debug(sheets)
+    return (filename, file.read(), UPLOAD_ENGINES[filename_split[-1]]), None
 
-    flag = False
-    # For Each sheet
-    for country_name in sheets:
-        try:
-            # If country exist take id, else, create a new country and take the
-            # new id
-            country: PriceCountry = PriceCountry.query \
-                .filter(PriceCountry.name == country_name.upper()) \
-                .first()
 
-            country_id: int
-            if country is None:
-                country = PriceCountry()
-                country.name = country_name.upper()
-                country.code = country_name.upper()
-                db.session.add(country)
-                db.session.commit()
+def upload_dry_run():
+    """
+    If the upload request asks for a dry run.
+    """
+    return request.values.get('dry_run', 'false').lower() in ('1', 'true')
 
-            country_id = country.id
 
-        except Exception as exp:
-            logging.error(f"Error in database {exp}")
+def import_prices_workbook(content, engine, dry_run=False, job_id=None,
+                           force=False, replace=False):
+    """
+    Parse a prices workbook and apply it, see import_prices_sheet. Sheets
+    equal to the last ones applied for their country are skipped, and so is
+    the whole workbook if it's the last one applied, unless force or
+    replace is set.
+    job_id: PriceUploadJob to report the progress to, if any
+    replace: Remove the stored values missing in the sheets, else they're
+    kept so a file with some of the prices only updates those
+    Returns (response, status code).
+    """
+    # A sheet applied before without replace may still have values to remove
+    hashes = get_upload_hashes('prices') if not (force or replace) else {}
+    digest = workbook_digest(content)
+    if hashes.get(WORKBOOK_HASH_NAME) == digest:
+        return {'status': 'OK', 'dry_run': dry_run, 'diff': {}, 'applied': [],
+                'skipped': [name.upper() for name in
+                            workbook_sheet_names(content, engine)]}, 200
+
+    # Read sheets names as country name, parsing every sheet before
+    # touching the database
+    try:
+        price_sheets: dict = read_workbook_sheets(
+            content, engine, parse_prices_sheet, PRICE_SHEET_COLUMNS)
+    except SheetError as exp:
+        msg = f"Error reading rows: {exp}"
+        logging.error(msg)
+        return {"message": msg, "errors": exp.errors}, 421
+
+    logging.debug('Prices sheets read: %s', list(price_sheets))
+    sheet_hashes = {}
+    skipped = []
+    for country_name in list(price_sheets):
+        sheet_hash = sheet_digest(price_sheets[country_name])
+        if hashes.get(country_name.upper()) == sheet_hash:
+            skipped.append(country_name.upper())
+            del price_sheets[country_name]
+        else:
+            sheet_hashes[country_name.upper()] = sheet_hash
+    if job_id is not None:
+        update_upload_job(
+            job_id, sheets_total=len(price_sheets),
+            rows_total=sum(len(sheet) for sheet in price_sheets.values()))
+
+    # Write all the sheets in one transaction, only the values that differ
+    # from the stored ones. A dry run rolls it back.
+    try:
+        index = PriceImportIndex(price_sheets.keys())
+        diff = {}
+        rows_processed = 0
+        for sheets_processed, (country_name, price_sheet) in enumerate(
+                price_sheets.items(), start=1):
+            diff[country_name.upper()] = import_prices_sheet(
+                country_name, price_sheet, index, replace)
+            rows_processed += len(price_sheet)
+            if job_id is not None:
+                update_upload_job(job_id, sheets_processed=sheets_processed,
+                                  rows_processed=rows_processed)
+        changed = index.created_modules or index.created_categories or any(
+            sheet_diff['inserted'] or sheet_diff['changed']
+            or sheet_diff['removed'] for sheet_diff in diff.values())
+        if dry_run:
             db.session.rollback()
-            return jsonify({'message': f"Error in database {exp}"}), 500
-
-        modules_hash = {}
-        category_hash = {}
-        subcategory_hash = {}
-
-        last_category_name = None
-        last_category_is_base = None
-        #same_category_cycle = False
-        category_low_value = 0
-        category_medium_value = 0
-        category_high_value = 0
-
-        for row in sheets[country_name].iterrows():
-            is_base = False
-            if row[1][constants.ROW_PRE] == 'BASE':
-                is_base = True
-            if last_category_is_base is None:
-                last_category_is_base = is_base
-            # Carga de costos variables
-            # Read Column "MODULO" and find Module by name
-            if not is_base:
-                module_name = row[1][constants.ROW_MODULO]
-                if module_name not in modules_hash:
-                    logging.debug(module_name)
-                    module: PriceModule = PriceModule.query.filter(
-                        PriceModule.name == module_name).first()
-                    if module is None:
-                        try:
-                            module = PriceModule()
-                            module.name = module_name
-                            db.session.add(module)
-                            db.session.commit()
-                            modules_hash[module_name] = module
-
-                        except Exception as exp:
-                            logging.error(f"Database error. {exp}")
-                            db.session.rollback()
-                            return jsonify({'message': f"Database error. {exp}"}), 500
-                    else:
-                        modules_hash[module_name] = module
-                else:
-                    module: PriceModule = PriceModule.query.filter(
-                        PriceModule.name == module_name).first()
-
-            # Read Column "PARAMETRO" and find a "PriceCategory"
-            category_name = row[1][constants.ROW_MODULO] if is_base else row[1][constants.ROW_PARAMETRO]
-            # finding if it's type A or B
-            if len(category_name.split('(')) > 1:
-                category_type = 'B'
+        else:
+            sheet_hashes[WORKBOOK_HASH_NAME] = digest
+            set_upload_hashes('prices', sheet_hashes)
+            if changed:
+                # The new version becomes visible to the estimates with the
+                # commit, all the sheets at once
+                version = publish_price_version(
+                    [index.countries[name.upper()].id
+                     for name in price_sheets], 'upload')
             else:
-                category_type = 'A'
-
-            '''
-            if  last_category_name != category_name and same_category_cycle == True:
-                print(last_category_name,last_category.id)
-                same_category_cycle = False
-                last_category_name = None
-                category_low_value = 0
-                category_medium_value = 0
-                category_high_value = 0
-            '''
-            if not last_category_name is None and last_category_name != category_name:
-                last_category = category_hash[last_category_name]
-                # print(last_category.id)
-                try:
-                    if is_base:
-                        value = PriceValue.query.filter(
-                            PriceValue.country_id == country_id) .filter(
-                            PriceValue.category_id == last_category.id) .first()
-                    else:
-                        value = PriceValue.query.filter(
-                            PriceValue.module_id == modules_hash[module_name].id) .filter(
-                            PriceValue.country_id == country_id) .filter(
-                            PriceValue.category_id == last_category.id) .first()
-                except Exception as exp:
-                    logging.error(f"Database error {exp}")
-                    return jsonify({'message': f"Database error {exp}"}), 500
+                db.session.commit()
+    except Exception as exp:
+        logging.error(f"Database error {exp}")
+        db.session.rollback()
+        return {'message': f"Database error {exp}"}, 500
+    if job_id is not None:
+        # Databases that lock the whole table can't see the progress until
+        # the import transaction ends
+        update_upload_job(job_id, sheets_processed=len(price_sheets),
+                          rows_processed=rows_processed)
+
+    if changed and not dry_run:
+        if index.created_categories:
+            invalidate_category_tree()
+        reload_price_matrices(price_sheets.keys(), version)
+
+    # Return status
+    return {'status': 'OK', 'dry_run': dry_run, 'diff': diff,
+            'applied': list(diff), 'skipped': skipped}, 200
+
+
+def update_upload_job(job_id, **values):
+    """
+    Update the columns of a PriceUploadJob. It uses its own connection and
+    transaction, so the progress is visible while the import transaction is
+    still open. Returns False if it can't be updated.
+    """
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(
+                PriceUploadJob.__table__.update()
+                .where(PriceUploadJob.__table__.c.id == job_id)
+                .values(**values))
+        return True
+    except SQLAlchemyError as exp:
+        # Reporting the progress must not fail the import
+        logging.warning(f"Can't update upload job {job_id}: {exp}")
+        return False
+
+
+def finish_upload_job(job_id, status, **values):
+    """
+    Set the final status of a PriceUploadJob with its result or error. If
+    those can't be stored the status is set alone, in its own transaction,
+    so the job doesn't look queued or running forever.
+    """
+    finished_at = dt.datetime.now()
+    if not update_upload_job(job_id, status=status, finished_at=finished_at,
+                             **values):
+        update_upload_job(job_id, status=status, finished_at=finished_at,
+                          error="The job result can't be stored")
+
+
+def upload_job_result(resp):
+    """
+    Upload response stored by a done PriceUploadJob: the diff of each country
+    without its 'rows', which grow with the workbook.
+    """
+    return dict(resp, diff={
+        country_name: {key: value for key, value in diff.items()
+                       if key != 'rows'}
+        for country_name, diff in resp.get('diff', {}).items()})
 
-                if value is None:
-                    value = PriceValue()
-                    try:
-                        country.values.append(value)
-                        db.session.commit()
-                        last_category.values.append(value)
-                        db.session.commit()
-                        if not last_category_is_base:
-                            module.values.append(value)
-                            db.session.commit()
-                    except Exception as exp:
-                        logging.error(f"Database error {exp}")
-                        return jsonify({'message': f"Database error {exp}"}), 500
 
-                value.low = category_low_value
-                value.medium = category_medium_value
-                value.high = category_high_value
+_upload_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=UPLOAD_JOB_WORKERS, thread_name_prefix='upload')
 
-                category_low_value = 0
-                category_medium_value = 0
-                category_high_value = 0
-            '''
+
+def run_upload_job(job_id, content, engine, dry_run, force=False,
+                   replace=False):
+    """
+    Import the workbook of a PriceUploadJob. Runs in the upload executor.
+    """
+    with app.app_context():
+        try:
+            update_upload_job(job_id, status=UploadJobStatus.running.value)
+            resp, code = import_prices_workbook(
+                content, engine, dry_run, job_id, force, replace)
+            if code == 200:
+                finish_upload_job(job_id, UploadJobStatus.done.value,
+                                  result=json.dumps(upload_job_result(resp)))
             else:
-                #setting a flag, to reset last_category_name to None if the cycle with categories is done
-                if last_category_name == category_name and last_category_name is not None:
-                    same_category_cycle = True
-            '''
-            if category_name not in category_hash:
-                category: PriceCategory = PriceCategory.query \
-                    .filter(PriceCategory.name == category_name) \
-                    .first()
+                finish_upload_job(job_id, UploadJobStatus.failed.value,
+                                  error=resp['message'])
+        except Exception as exp:
+            logging.error(f"Upload job {job_id} failed: {exp}")
+            finish_upload_job(job_id, UploadJobStatus.failed.value,
+                              error=str(exp))
+        finally:
+            db.session.remove()
 
-                # If PriceCategory exist get id else create and get the id.
-                if category is None:
-                    try:
-                        category = PriceCategory()
-                        category.name = category_name
-                        category.code = category_name if not is_base else 'BASE'
 
-                        category.type = category_type
+@app.route('/api/prices/upload/jobs', methods=['POST'])
+@token_required
+def create_upload_job():
+    """
+        Upload/Update Prices in the background
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        consumes:
+        - "multipart/form-data"
+        parameters:
+        - name: "file"
+          in: "formData"
+          description: "File to upload, same as /api/prices/upload"
+          required: true
+          type: file
+        - name: "force"
+          in: "query"
+          description: "If true, apply the sheets even if they're unchanged"
+          required: false
+          type: boolean
+        - name: "replace"
+          in: "query"
+          description: "If true, remove the stored values of each country missing in its sheet"
+          required: false
+          type: boolean
+        - name: "dry_run"
+          in: "query"
+          description: "If true, only compute the diff"
+          required: false
+          type: boolean
+        responses:
+            202:
+              description: "{'job_id': id}, follow it in /api/prices/upload/jobs/<job_id>"
+    """
+    workbook, error = read_upload_workbook()
+    if error is not None:
+        return error
+
+    filename, content, engine = workbook
+    job = PriceUploadJob(id=uuid.uuid4().hex, filename=filename,
+                         dry_run=upload_dry_run(), force=upload_force(),
+                         replace=upload_replace())
+    try:
+        db.session.add(job)
+        db.session.commit()
+    except Exception as exp:
+        logging.error(f"Database error {exp}")
+        db.session.rollback()
+        return jsonify({'message': f"Database error {exp}"}), 500
 
-                        db.session.add(category)
-                        db.session.commit()
-                        category_hash[category_name] = category
+    _upload_executor.submit(run_upload_job, job.id, content, engine,
+                            job.dry_run, job.force, job.replace)
+    return jsonify({'job_id': job.id}), HTTPStatus.ACCEPTED
 
-                    except Exception as exp:
-                        logging.error(f'Database error. {exp}')
-                        db.session.rollback()
-                        return jsonify({'message': f"Database error. {exp}"}), 500
-                else:
-                    category_hash[category_name] = category
+
+@app.route('/api/prices/upload/jobs/<job_id>', methods=['GET'])
+@token_required
+def get_upload_job(job_id):
+    """
+        Get the status and progress of an upload job
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        parameters:
+        - in: path
+          name: job_id
+          type: string
+          required: true
+        responses:
+            200:
+              description: Status, sheets and rows processed, and the error or upload response (without the rows of each diff) once it's finished
+            404:
+              description: Job not found
+    """
+    job = PriceUploadJob.query.get(job_id)
+    if job is None:
+        return jsonify({'message': f'Job {job_id} not found'}), 404
+    now = dt.datetime.now()
+    # Only the stale job being read is written, not on every poll
+    if is_stale_upload_job(job, now):
+        job.status = UploadJobStatus.failed.value
+        job.error = UPLOAD_JOB_LOST
+        job.finished_at = now
+        db.session.commit()
+    return jsonify(job.to_dict()), 200
+
+
+@app.route('/api/prices/versions', methods=['GET'])
+@token_required
+def get_price_versions():
+    """
+        Get the published versions of the prices
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        responses:
+            200:
+              description: "{'current': version, 'versions': [...]} with the source, date and countries published by each version, newest first"
+    """
+    versions = OrderedDict()
+    for version, source, created_at, country_name in db.session.query(
+            PriceSnapshot.version, PriceSnapshot.source,
+            PriceSnapshot.created_at, PriceCountry.name) \
+            .join(PriceCountry, PriceCountry.id == PriceSnapshot.country_id) \
+            .order_by(PriceSnapshot.version.desc(), PriceCountry.name):
+        if version not in versions:
+            versions[version] = {'version': version, 'source': source,
+                                 'created_at': created_at, 'countries': []}
+        versions[version]['countries'].append(country_name)
+
+    return jsonify({'current': get_price_table_version(),
+                    'versions': list(versions.values())}), 200
+
+
+@app.route('/api/prices/versions/<int:version>/rollback', methods=['POST'])
+@token_required
+def rollback_price_version(version):
+    """
+        Publish the prices of a past version again
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        parameters:
+        - in: path
+          name: version
+          type: integer
+          required: true
+        responses:
+            200:
+              description: "{'status': 'OK', 'version': new version, 'restored': version, 'countries': {country: diff}}"
+            404:
+              description: Version not found
+            500:
+              description: Database error
+    """
+    if version > get_price_table_version():
+        return jsonify({'message': f'Version {version} not found'}), 404
+
+    # Latest snapshot of each country up to the version. Countries created
+    # after it are left as they are.
+    snapshots = {}
+    for snapshot_version, country_id in db.session.query(
+            PriceSnapshot.version, PriceSnapshot.country_id) \
+            .filter(PriceSnapshot.version <= version):
+        snapshots[country_id] = max(snapshot_version,
+                                    snapshots.get(country_id, 0))
+    if not snapshots:
+        return jsonify({'message': f'Version {version} not found'}), 404
+
+    try:
+        countries = {}
+        for country_id, snapshot_version in snapshots.items():
+            values, _, design = PriceSnapshot.query.get(
+                (snapshot_version, country_id)).decode()
+            stored = {
+                (module_id, category_id): (value_id, tuple(levels))
+                for value_id, module_id, category_id, *levels in
+                db.session.query(PriceValue.id, PriceValue.module_id,
+                                 PriceValue.category_id, PriceValue.low,
+                                 PriceValue.medium, PriceValue.high)
+                .filter(PriceValue.country_id == country_id)}
+            diff = write_price_values(
+                country_id,
+                {(module_id, category_id): levels
+                 for module_id, category_id, *levels in values},
+                stored, replace=True)
+            del diff['rows']
+
+            price_design = PriceDesign.query.filter(
+                PriceDesign.country_id == country_id).first()
+            if design is None:
+                if price_design is not None:
+                    db.session.delete(price_design)
             else:
-                category: PriceCategory = PriceCategory.query \
-                    .filter(PriceCategory.name == category_name) \
-                    .first()
+                if price_design is None:
+                    price_design = PriceDesign(country_id=country_id)
+                    db.session.add(price_design)
+                price_design.category_1, price_design.category_2, \
+                    price_design.category_3, price_design.category_4, \
+                    price_design.category_5 = design
+
+            countries[PriceCountry.query.get(country_id).name] = diff
+
+        # The next uploads must be applied even if they equal the last ones
+        PriceUploadHash.query.delete(synchronize_session=False)
+        new_version = publish_price_version(snapshots, 'rollback')
+    except Exception as exp:
+        logging.error(f"Database error {exp}")
+        db.session.rollback()
+        return jsonify({'message': f"Database error {exp}"}), 500
 
-            subcategory_name = row[1][constants.ROW_DETALLE]
-            subcategory_code = ''
-            have_subcat = True
-            if pd.isna(subcategory_name):
-                have_subcat = False
-            if have_subcat:
-                if flag:
-                    print('have_subcat')
-                subcategory_code = category_name + ' ' + subcategory_name
-                if subcategory_code not in subcategory_hash:
-                    subcategory: PriceCategory = PriceCategory.query \
-                        .filter(PriceCategory.name == subcategory_name) \
-                        .filter(PriceCategory.parent_category_id == category.id) \
-                        .first()
+    reload_price_matrices(countries, new_version)
+    return jsonify({'status': 'OK', 'version': new_version,
+                    'restored': version, 'countries': countries}), 200
 
-                    # If PriceCategory exist get id else create and get the id.
-                    if subcategory is None:
-                        try:
-                            subcategory = PriceCategory()
-                            subcategory.name = subcategory_name
-                            subcategory.code = subcategory_code if not is_base else 'BASE'
-                            subcategory.type = category_type
-                            category.subcategories.append(subcategory)
-                            db.session.add(subcategory)
-                            db.session.commit()
-                            subcategory_hash[subcategory_code] = subcategory
-
-                        except Exception as exp:
-                            logging.error(f'Database error. {exp}')
-                            db.session.rollback()
-                            return jsonify({'message': f"Database error. {exp}"}), 500
-                    else:
-                        subcategory_hash[subcategory_code] = subcategory
-                else:
-                    subcategory: PriceCategory = PriceCategory.query \
-                        .filter(PriceCategory.name == subcategory_name) \
-                        .filter(PriceCategory.parent_category_id == category.id) \
-                        .first()
-            # Read columns "ESTANDAR BAJO", "ESTANDAR MEDIO", "ESTANDAR ALTO".
-            try:
-                low: float = row[1][constants.ROW_BAJO] if not pd.isna(row[1][constants.ROW_BAJO]) else 0
-                medium: float = row[1][constants.ROW_MEDIO] if not pd.isna(row[1][constants.ROW_MEDIO]) else 0
-                high: float = row[1][constants.ROW_ALTO] if not pd.isna(row[1][constants.ROW_ALTO]) else 0
 
-            except Exception as exp:
-                msg = f"Error reading rows: {constants.ROW_BAJO}, " \
-                    f"{constants.ROW_MEDIO}, {constants.ROW_ALTO}: {exp}"
-                logging.error(msg)
-                return jsonify({"message": msg}), 421
+XLSX_MIMETYPE = \
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
-            # Get a price value by PriceCountry, PriceCategory and PriceModule. If Exist
-            # get Object else, create a new object. Update or create the values
-            # low, medium and high.
-            module_id = modules_hash[module_name].id if not is_base else None
-            subcategory_id = subcategory_hash[subcategory_code].id if have_subcat else category_hash[category_name].id
+# Design price ranges in the order of PriceDesign.category_1, ..., category_5
+DESIGN_CATEGORIES = (constants.CATEGORY_1, constants.CATEGORY_2,
+                     constants.CATEGORY_3, constants.CATEGORY_4,
+                     constants.CATEGORY_5)
 
-            module = modules_hash[module_name] if not is_base else None
-            subcategory = subcategory_hash[subcategory_code] if have_subcat else category_hash[category_name]
 
-            try:
-                if is_base:
-                    value = PriceValue.query.filter(
-                        PriceValue.country_id == country_id) .filter(
-                        PriceValue.category_id == subcategory_id) .first()
-                else:
-                    value = PriceValue.query.filter(
-                        PriceValue.module_id == module_id) .filter(
-                        PriceValue.country_id == country_id) .filter(
-                        PriceValue.category_id == subcategory_id) .first()
-            except Exception as exp:
-                logging.error(f"Database error {exp}")
-                return jsonify({'message': f"Database error {exp}"}), 500
+def price_export_rows(country_id, categories, modules):
+    """
+    Rows of the prices of a country in the layout of the prices template
+    (PRICE_SHEET_COLUMNS). Values are read in chunks of EXPORT_CHUNK_SIZE
+    and only the rows of one module are held at a time. Categories with
+    subcategories are written by subcategory, their value is the sum the
+    upload computes.
+    categories: (name, parent_category_id) by PriceCategory id
+    modules: Name by PriceModule id
+    """
+    values = db.session.query(PriceValue.module_id,
+                              PriceValue.category_id,
+                              PriceValue.low,
+                              PriceValue.medium,
+                              PriceValue.high) \
+        .filter(PriceValue.country_id == country_id) \
+        .order_by(PriceValue.module_id, PriceValue.category_id) \
+        .yield_per(EXPORT_CHUNK_SIZE)
+
+    for module_id, module_values in itertools.groupby(
+            values, key=lambda value: value[0]):
+        module_values = list(module_values)
+        parents = {categories[category_id][1]
+                   for _, category_id, *_ in module_values}
+        rows = []
+        for _, category_id, low, medium, high in module_values:
+            if category_id in parents:
+                continue
+            name, parent_id = categories[category_id]
+            category_name = categories[parent_id][0] \
+                if parent_id is not None else name
+            detail = name if parent_id is not None else None
+            if module_id is None:
+                row = ['BASE', category_name,
+                       'BASE' if detail is not None else None, detail]
+            else:
+                row = [None, modules[module_id], category_name, detail]
+            rows.append(((parent_id or category_id, category_id),
+                         row + [low, medium, high]))
+        rows.sort(key=lambda row: row[0])
+        for _, row in rows:
+            yield row
 
-            if value is None:
-                value = PriceValue()
-                try:
-                    country.values.append(value)
-                    db.session.commit()
-                    subcategory.values.append(value)
-                    db.session.commit()
-                    if not is_base:
-                        module.values.append(value)
-                    db.session.commit()
-                except Exception as exp:
-                    logging.error(f"Database error {exp}")
-                    return jsonify({'message': f"Database error {exp}"}), 500
 
-            category_low_value += low
-            category_medium_value += medium
-            category_high_value += high
+def design_export_rows(country_id):
+    """
+    [design category, price] of each range of the design prices of a
+    country, none if it has no design prices.
+    """
+    _, design = design_prices(PriceDesign.query.filter(
+        PriceDesign.country_id == country_id).first())
+    if design is None:
+        return []
+    return [[category, value]
+            for category, value in zip(DESIGN_CATEGORIES, design)]
 
-            value.low = low
-            value.medium = medium
-            value.high = high
 
-            last_category_name = category_name
-            last_category_is_base = is_base
-            # commit database
-            try:
-                db.session.commit()
-            except Exception as exp:
-                db.session.rollback()
-                logging.error(f"Database error {exp}")
-                return jsonify({'message': f"Database error {exp}"}), 500
-    # Return status
-    return jsonify({'status': 'OK'})
+def export_csv(countries, header, country_rows):
+    """
+    Stream the rows of each country as CSV, with the country in a first
+    PAIS column, the layout /api/prices/upload takes.
+    countries: PriceCountry list
+    country_rows: Function that yields the rows of a country id
+    """
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([constants.ROW_PAIS] + header)
+        for country in countries:
+            for row in country_rows(country.id):
+                writer.writerow([country.name] + row)
+                if buffer.tell() > 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+        yield buffer.getvalue()
+
+    return app.response_class(
+        stream_with_context(generate()), mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=prices.csv'})
+
+
+def export_xlsx(countries, header, country_rows, filename):
+    """
+    Write the rows of each country to a sheet of a write-only workbook,
+    which keeps only the current row in memory, and send it.
+    header: Function that returns the first rows of a country's sheet
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    for country in countries:
+        sheet = workbook.create_sheet(country.name[:31])
+        for row in itertools.chain(header(country), country_rows(country.id)):
+            sheet.append(row)
+    file = tempfile.TemporaryFile()
+    workbook.save(file)
+    file.seek(0)
+    return send_file(file, mimetype=XLSX_MIMETYPE, as_attachment=True,
+                     download_name=filename)
+
+
+@app.route('/api/prices/export', methods=['GET'])
+@token_required
+def export_prices():
+    """
+        Export the prices or design prices
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        - "text/csv"
+        parameters:
+        - name: "format"
+          in: "query"
+          description: "xlsx (default), a sheet per country in the layout of the upload templates, or csv, with a PAIS column"
+          required: false
+          type: string
+          enum: [xlsx, csv]
+        - name: "kind"
+          in: "query"
+          description: "prices (default) or design"
+          required: false
+          type: string
+          enum: [prices, design]
+        - name: "country"
+          in: "query"
+          description: "Countries to export, all of them if not given"
+          required: false
+          type: array
+          items:
+            type: string
+          collectionFormat: multi
+        responses:
+            200:
+              description: The exported file
+            400:
+              description: Invalid format or kind
+            404:
+              description: Country not found
+    """
+    export_format = request.args.get('format', 'xlsx').lower()
+    kind = request.args.get('kind', 'prices').lower()
+    if export_format not in ('xlsx', 'csv') or kind not in ('prices', 'design'):
+        return jsonify({'message': f'{export_format} {kind} export is not '
+                                   f'valid'}), HTTPStatus.BAD_REQUEST
+
+    names = [name.upper() for name in request.args.getlist('country')]
+    try:
+        query = PriceCountry.query.order_by(PriceCountry.name)
+        if names:
+            query = query.filter(PriceCountry.name.in_(names))
+        countries = query.all()
+        missing = set(names) - {country.name for country in countries}
+        if missing:
+            return jsonify({'message': f'{", ".join(sorted(missing))} '
+                                       f'not found'}), 404
+
+        if kind == 'prices':
+            categories = {
+                category_id: (name, parent_id)
+                for category_id, name, parent_id in db.session.query(
+                    PriceCategory.id, PriceCategory.name,
+                    PriceCategory.parent_category_id)}
+            modules = dict(db.session.query(PriceModule.id, PriceModule.name))
+
+            def country_rows(country_id):
+                return price_export_rows(country_id, categories, modules)
+
+            if export_format == 'csv':
+                return export_csv(countries, PRICE_SHEET_COLUMNS, country_rows)
+            return export_xlsx(countries, lambda country: [PRICE_SHEET_COLUMNS],
+                               country_rows, 'prices.xlsx')
+
+        # Countries without design prices are left out, uploading an empty
+        # sheet would create them in 0
+        with_design = {country_id for country_id, in
+                       db.session.query(PriceDesign.country_id)}
+        countries = [country for country in countries
+                     if country.id in with_design]
+        if export_format == 'csv':
+            return export_csv(countries, DESIGN_TABLE_COLUMNS,
+                              design_export_rows)
+
+        def design_sheet(country_id):
+            # Title of the ranges in the first column of the first one
+            for i, row in enumerate(design_export_rows(country_id)):
+                yield ['Costo de Diseño por m2' if i == 0 else None] + row
+
+        return export_xlsx(countries,
+                           lambda country: [[None, None, country.name]],
+                           design_sheet, 'design_prices.xlsx')
+    except SQLAlchemyError as exp:
+        logging.error(f"Database error {exp}")
+        return jsonify({'message': f"Database error {exp}"}), 500
 
 
 @app.route('/api/prices/create', methods=['GET'])
@@ -1006,6 +2887,9 @@ def save_prices():
                             description: space_id
             country:
                 type: string
+            price_version:
+                type: integer
+                description: Optional price table version the project was priced with, the current one by default. It's returned by /api/prices/load.
         responses:
             400:
                 description: Data or missing field in body.
@@ -1031,10 +2915,15 @@ def save_prices():
             return jsonify({'message': f'{param} not in body'}), \
                 HTTPStatus.BAD_REQUEST
 
+    price_version, error = get_request_price_version(request.json)
+    if error is not None:
+        return error
+    version, _ = price_version
+
     try:
         token = request.headers.get('Authorization', None)
         headers = {'Authorization': token}
-        resp = requests.get(
+        resp = downstream.get(
             f'{PROJECTS_URL}{PROJECTS_MODULE_API}'
             f'/{request.json["project_id"]}', headers=headers)
         project = json.loads(resp.content.decode('utf-8'))
@@ -1059,6 +2948,9 @@ def save_prices():
         price_gen.value = request.json["value"]
         price_gen.m2 = request.json["m2"]
         db.session.add(price_gen)
+        db.session.flush()
+        db.session.merge(PriceGenVersion(price_gen_id=price_gen.id,
+                                         version=version))
         db.session.commit()
 
         price_gen_id = price_gen.id
@@ -1084,21 +2976,13 @@ def save_prices():
         return {'message': f'{exp}'}, \
             HTTPStatus.BAD_REQUEST
 
-    spaces = {}
     # Get all spaces.
-    for _space in workspaces:
-        try:
-            token = request.headers.get('Authorization', None)
-            headers = {'Authorization': token}
-            resp = requests.get(
-                f'http://{SPACES_MODULE_HOST}:{SPACES_MODULE_PORT}{SPACES_MODULE_API}'
-                f'/{_space["space_id"]}', headers=headers)
-            space = json.loads(resp.content.decode('utf-8'))
-            spaces[space['id']] = space['name']
-
-        except Exception as exp:
-            logging.error(f"Error getting spaces {exp}")
-            return f"Error getting spaces {exp}", 500
+    try:
+        space_modules = get_spaces_modules(
+            [_space['space_id'] for _space in workspaces], token)
+    except Exception as exp:
+        logging.error(f"Error getting spaces {exp}")
+        return f"Error getting spaces {exp}", 500
 
     # Get Country id
     country_name = request.json['country']
@@ -1111,26 +2995,25 @@ def save_prices():
 
     i = 0
     while i < len(workspaces):
-        space_name = spaces[workspaces[i]['space_id']]
+        space_id = workspaces[i]['space_id']
         # Get PriceModule id
-        price_module: PriceModule = PriceModule.query.filter(
-            PriceModule.name == space_name).first()
-        if price_module is None:
-            logging.warning(f'No module name: {space_name}')
+        price_module_id = space_modules[space_id]
+        if price_module_id is None:
+            logging.warning(f'No module for space: {space_id}')
         else:
             # Get specific price and save record relation:
             for category in categories:
                 if category['code'] == 'BASE':
                     module_id = None
                 else:
-                    module_id = price_module.id
+                    module_id = price_module_id
 
                 prices = PriceValue.query.filter(PriceValue.country_id == country.id) \
                     .filter(PriceValue.module_id == module_id) \
                     .filter(PriceValue.category_id == category['id']).first()
                 if prices is None:
                     logging.warning(
-                        f'No price value for category: {category["name"]} and module: {price_module.name}')
+                        f'No price value for category: {category["name"]} and module: {price_module_id}')
                 else:
                     pghpv = PriceGenHasPriceValue.query.filter(PriceGenHasPriceValue.price_gen_id == price_gen_id) \
                         .filter(PriceGenHasPriceValue.price_value_id == prices.id).first()
@@ -1157,7 +3040,7 @@ def save_prices():
 def update_project_by_id(project_id, data, token):
     headers = {'Authorization': token}
     api_url = PROJECTS_URL + PROJECTS_MODULE_API + str(project_id)
-    rv = requests.put(api_url, json=data, headers=headers)
+    rv = downstream.put(api_url, json=data, headers=headers)
     if rv.status_code == 200:
         return json.loads(rv.text)
     elif rv.status_code == 500:
@@ -1168,7 +3051,7 @@ def update_project_by_id(project_id, data, token):
 def get_workspace_by_project_id(project_id, token):
     headers = {'Authorization': token}
     api_url = M2_URL + M2_MODULE_API + '/' + str(project_id)
-    rv = requests.get(api_url, headers=headers)
+    rv = downstream.get(api_url, headers=headers)
     if rv.status_code == 200:
         return json.loads(rv.text)
     elif rv.status_code == 500:
@@ -1176,6 +3059,425 @@ def get_workspace_by_project_id(project_id, token):
     return None
 
 
+_spaces_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=SPACES_FETCH_WORKERS, thread_name_prefix='spaces')
+# Calls to the spaces uservice are retried by get_space, within the deadline
+# of their request, so a slow service doesn't keep the executor busy after
+# the request gave up.
+spaces_session = DownstreamSession(
+    timeout=(DOWNSTREAM_CONNECT_TIMEOUT, SPACES_FETCH_DEADLINE),
+    pool_size=DOWNSTREAM_POOL_SIZE,
+    retries=0,
+    backoff=0)
+
+
+def get_space(space_id, token, deadline):
+    """
+    Get a space from the spaces uservice, retrying connection errors,
+    timeouts and 502/503/504 up to DOWNSTREAM_RETRIES times. No attempt
+    outlives deadline (time.monotonic() value).
+
+    Exceptions:
+    - Exception: The deadline passed before an answer
+    - requests.RequestException: The last attempt failed
+    """
+    headers = {'Authorization': token}
+    url = f'http://{SPACES_MODULE_HOST}:{SPACES_MODULE_PORT}' \
+          f'{SPACES_MODULE_API}/{space_id}'
+    for attempt in range(DOWNSTREAM_RETRIES + 1):
+        if attempt:
+            time.sleep(DOWNSTREAM_BACKOFF * 2 ** (attempt - 1))
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f"Space {space_id} didn't answer in time")
+        last = attempt == DOWNSTREAM_RETRIES
+        try:
+            resp = spaces_session.get(
+                url, headers=headers,
+                timeout=(min(DOWNSTREAM_CONNECT_TIMEOUT, remaining), remaining))
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+            continue
+        if resp.status_code not in (502, 503, 504) or last:
+            return json.loads(resp.content.decode('utf-8'))
+
+
+def get_spaces_names(space_ids, token):
+    """
+    Get the names of the spaces from the spaces uservice. Each distinct id
+    is requested once, concurrently, and all of them must answer within
+    SPACES_FETCH_DEADLINE seconds.
+    Returns a dict space id -> space name.
+
+    Exceptions:
+    - Exception: The spaces uservice couldn't be reached, answered an
+      invalid space or didn't answer in time.
+    """
+    deadline = time.monotonic() + SPACES_FETCH_DEADLINE
+    futures = [_spaces_executor.submit(get_space, space_id, token, deadline)
+               for space_id in set(space_ids)]
+    done, not_done = concurrent.futures.wait(
+        futures, timeout=SPACES_FETCH_DEADLINE)
+    if not_done:
+        # The ones already running end by the deadline too
+        for future in not_done:
+            future.cancel()
+        raise Exception(f"{len(not_done)} spaces didn't answer in "
+                        f"{SPACES_FETCH_DEADLINE} seconds")
+
+    spaces = {}
+    for future in done:
+        space = future.result()
+        spaces[space['id']] = space['name']
+    return spaces
+
+
+# space id -> PriceModule id (None if no module has the space's name)
+spaces_modules_cache = TTLCache(SPACES_CACHE_SIZE, SPACES_CACHE_TTL)
+
+
+def get_spaces_modules(space_ids, token):
+    """
+    Resolve spaces to their PriceModule (the module with the space's name).
+    Only the spaces missing in spaces_modules_cache are requested to the
+    spaces uservice, and their modules are found with a single query.
+    Spaces without a module aren't cached, so they are found as soon as an
+    upload (to any worker) adds their module.
+    Returns a dict space id -> PriceModule id or None.
+
+    Exceptions:
+    - Exception: see get_spaces_names
+    """
+    space_modules = {}
+    missing = []
+    for space_id in set(space_ids):
+        module_id = spaces_modules_cache.get(space_id, CACHE_MISS)
+        if module_id is CACHE_MISS:
+            missing.append(space_id)
+        else:
+            space_modules[space_id] = module_id
+
+    if missing:
+        spaces = get_spaces_names(missing, token)
+        modules = db.session.query(PriceModule.name, PriceModule.id) \
+            .filter(PriceModule.name.in_(set(spaces.values()))) \
+            .all()
+        module_ids = {}
+        for name, module_id in modules:
+            module_ids.setdefault(name, module_id)
+        for space_id, space_name in spaces.items():
+            module_id = module_ids.get(space_name)
+            if module_id is not None:
+                spaces_modules_cache.set(space_id, module_id)
+            space_modules[space_id] = module_id
+
+    return space_modules
+
+
+def get_space_rows(matrix, space_modules, workspaces):
+    """
+    Find the matrix row of each workspace's space. Workspaces whose space
+    has no prices are removed from the list.
+    Returns a dict space id -> row in matrix.values
+    """
+    space_rows = {}
+    i = 0
+    while i < len(workspaces):
+        space_id = workspaces[i]['space_id']
+        row = matrix.module_rows.get(space_modules[space_id])
+        if row is None:
+            logging.warning(f'No prices for space: {space_id}')
+            workspaces.remove(workspaces[i])
+            i = i-1
+        else:
+            space_rows[workspaces[i]['space_id']] = row
+        i = i+1
+    return space_rows
+
+
+def get_base_multiplier(category_name, m2, weeks):
+    """
+    Factor applied to a base category price according to constants.BASES_CALC
+    (m2, m2/<divisor>, weeks). Categories not listed are a fixed price.
+    """
+    calc_type = ''
+    div_factor = 1
+    if category_name in constants.BASES_CALC:
+        calc_type = constants.BASES_CALC[category_name]
+        calc_type = calc_type.split('/')
+        if len(calc_type) > 1:
+            div_factor = float(calc_type[1])
+        calc_type = calc_type[0]
+
+    if calc_type == 'm2':
+        return m2/div_factor
+    elif calc_type == 'weeks':
+        return weeks
+    return 1
+
+
+def estimate_prices(matrix, space_rows, workspaces, categories, m2, weeks):
+    """
+    Price breakdown of a project in one pass over the price matrix.
+    Variable categories are priced with the quantity of every space, base
+    categories with the factor of get_base_multiplier. Every category is
+    priced at the three levels at once.
+
+    Returns a dict with:
+    - level_values: array (categories, PRICE_LEVELS) with the value of each
+      category at each level
+    - category_values: value of each category at its answered level, in the
+      order of categories
+    - subcategory_values: per category, dict subcategory id -> value
+    - design_value: design price for m2
+    - value: total price of the project
+    """
+    n_rows = matrix.values.shape[0]
+    # Quantity of each module row, the rollup of all the workspaces.
+    quantities = np.zeros(n_rows)
+    for _space in workspaces:
+        space_id = _space['space_id']
+        if space_id in space_rows:
+            quantities[space_rows[space_id]] += _space['quantity']
+        else:
+            logging.warning(f"Not valid space_id: {space_id}")
+
+    # Weight of each module row for each category.
+    weights = np.zeros((len(categories), n_rows))
+    levels = np.zeros(len(categories), dtype=int)
+    columns = np.zeros(len(categories), dtype=int)
+    known = np.zeros(len(categories), dtype=bool)
+    for i, category in enumerate(categories):
+        levels[i] = PRICE_LEVEL_INDEX[category['resp']]
+        if category['code'] != 'BASE':
+            weights[i] = quantities
+        else:
+            weights[i, PriceMatrix.BASE_ROW] = get_base_multiplier(
+                category['name'], m2, weeks)
+        column = matrix.category_columns.get(category['id'])
+        if column is not None:
+            columns[i] = column
+            known[i] = True
+
+    level_values = np.zeros((len(categories), len(PRICE_LEVELS)))
+    if known.any():
+        level_values[known] = np.einsum(
+            'cr,rcl->cl', weights[known], matrix.values[:, columns[known], :])
+    category_values = level_values[np.arange(len(categories)), levels]
+
+    subcategory_values = []
+    for i, category in enumerate(categories):
+        subcategories = {}
+        if category['id'] in matrix.subcategory_columns:
+            ids, sub_columns = matrix.subcategory_columns[category['id']]
+            sub_values = weights[i] @ matrix.values[:, sub_columns, levels[i]]
+            subcategories = dict(zip(ids, sub_values.tolist()))
+        subcategory_values.append(subcategories)
+
+    design_value = matrix.design_value(m2)
+    return {
+        'level_values': level_values,
+        'category_values': category_values.tolist(),
+        'subcategory_values': subcategory_values,
+        'design_value': design_value,
+        'value': float(category_values.sum()) + design_value
+    }
+
+
+def needs_project_weeks(categories):
+    """
+    If any of the categories is a base category priced by project weeks.
+    """
+    for category in categories:
+        if category['code'] == 'BASE' and \
+                constants.BASES_CALC.get(category['name']) == 'weeks':
+            return True
+    return False
+
+
+_estimate_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=ESTIMATE_IO_WORKERS, thread_name_prefix='estimate')
+
+
+def run_with_session(f, *args):
+    """
+    Run f in an executor thread, inside an app context. The thread's
+    database session is closed afterwards, so its connection goes back to
+    the pool.
+    """
+    with app.app_context():
+        try:
+            return f(*args)
+        finally:
+            db.session.remove()
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def wants_ndjson():
+    """
+    If the client prefers newline delimited JSON in its Accept header.
+    """
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def ndjson_response(records):
+    """
+    Stream records as newline delimited JSON, each one is serialized and
+    sent as soon as the iterable yields it.
+    """
+    def generate():
+        for record in records:
+            yield json.dumps(record) + '\n'
+
+    return app.response_class(stream_with_context(generate()),
+                              mimetype=NDJSON_MIMETYPE)
+
+
+estimates_cache = TTLCache(ESTIMATES_CACHE_SIZE, ESTIMATES_CACHE_TTL)
+
+# Response header with the PriceTableVersion of an estimate, to re-price it
+# later with 'price_version'
+PRICE_VERSION_HEADER = 'X-Price-Version'
+
+
+def estimate_cache_key(kind, body, version):
+    """
+    Canonical key of an estimate request for estimates_cache.
+    kind: Route the response is for, e.g. 'value' or 'detail'
+    body: /api/prices body
+    version: PriceTableVersion the response is priced with
+    Workspaces are reduced to (space_id, quantity) and sorted. Categories are
+    sorted unless kind is 'detail', whose response lists them in request
+    order. Returns None if the body can't be keyed, so it's not cached.
+    """
+    try:
+        workspaces = sorted(
+            [_space['space_id'], _space.get('quantity', 1)]
+            for _space in body['workspaces'])
+        categories = [json.dumps(category, sort_keys=True)
+                      for category in body['categories']]
+        if kind != 'detail':
+            categories.sort()
+        canonical = json.dumps({
+            'kind': kind,
+            'version': version,
+            'country': str(body['country']).upper(),
+            'm2': body['m2'],
+            'workspaces': workspaces,
+            'categories': categories
+        }, sort_keys=True)
+    except (KeyError, TypeError, AttributeError):
+        return None
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def cache_estimate(key, response):
+    """
+    Store an estimate response, unless its project weeks are a fallback
+    ('cache' or 'estimate') that would outlive the times service recovering.
+    """
+    if key is not None and response.get('weeks_source') in (None, 'times'):
+        estimates_cache.set(key, response)
+
+
+def get_request_price_version(body):
+    """
+    PriceTableVersion an estimate body is priced with: its optional
+    'price_version', to re-price a saved project with the prices it had, or
+    the current one.
+    Returns ((version, historic), None) or (None, error response). historic
+    is set if the version is a past one.
+    """
+    current = get_price_table_version()
+    price_version = body.get('price_version') if isinstance(body, dict) else None
+    if price_version is None or price_version == current:
+        return (current, False), None
+    if not isinstance(price_version, int) or isinstance(price_version, bool) \
+            or not 0 < price_version < current:
+        logging.error(f'price_version {price_version} is not valid')
+        return None, (jsonify({
+            'message': f'price_version {price_version} is not valid'}),
+            HTTPStatus.BAD_REQUEST)
+    return (price_version, True), None
+
+
+def estimate_request(body, token, with_weeks=False, version=None,
+                     historic=False):
+    """
+    Validate an /api/prices body and price it with estimate_prices.
+    Workspaces without prices are removed from body['workspaces'].
+    The spaces, the price matrix and the project weeks are fetched
+    concurrently. The project weeks are only requested if a category is
+    priced by weeks or with_weeks is set.
+
+    Returns (estimate, None) or (None, error response). The estimate also
+    has the matrix, the project weeks used and their source (see
+    get_project_weeks), both None if not requested.
+    version, historic: PriceTableVersion to price with, see get_price_matrix.
+    """
+    # Check JSON Input
+    params = {
+        'categories',
+        'workspaces',
+        'country',
+        'm2'
+    }
+
+    for param in params:
+        if param not in body:
+            logging.error(f'{param} not in body')
+            return None, (jsonify({'message': f'{param} not in body'}),
+                          HTTPStatus.BAD_REQUEST)
+
+    try:
+        workspaces: list = body['workspaces']
+        categories: list = body['categories']
+
+    except Exception as exp:
+        logging.error(exp)
+        return None, ({'message': f'{exp}'}, HTTPStatus.BAD_REQUEST)
+
+    country_name = body['country']
+    m2 = body['m2']
+    spaces_future = _estimate_executor.submit(
+        run_with_session, get_spaces_modules,
+        [_space['space_id'] for _space in workspaces], token)
+    matrix_future = _estimate_executor.submit(
+        run_with_session, get_price_matrix, country_name, version, historic)
+    weeks_future = None
+    if with_weeks or needs_project_weeks(categories):
+        weeks_future = _estimate_executor.submit(get_project_weeks, m2, token)
+
+    # Get all spaces.
+    try:
+        space_modules = spaces_future.result()
+    except Exception as exp:
+        logging.error(f"Error getting spaces {exp}")
+        return None, (f"Error getting spaces {exp}", 500)
+
+    # Get the compiled prices of the country
+    matrix = matrix_future.result()
+    if matrix is None:
+        return None, f'{country_name} is a invalid country'
+
+    space_rows = get_space_rows(matrix, space_modules, workspaces)
+
+    weeks = None
+    weeks_source = None
+    if weeks_future is not None:
+        weeks, weeks_source = weeks_future.result()
+    estimate = estimate_prices(
+        matrix, space_rows, workspaces, categories, m2, weeks)
+    estimate['matrix'] = matrix
+    estimate['weeks'] = weeks
+    estimate['weeks_source'] = weeks_source
+    return estimate, None
+
+
 @app.route('/api/prices/load/<project_id>', methods=['GET'])
 @token_required
 def get_project_prices(project_id):
@@ -1191,7 +3493,7 @@ def get_project_prices(project_id):
             - Prices
           responses:
             200:
-              description: Saved Price Gen Object, and related Price Value Data Object.
+              description: Saved Price Gen Object, and related Price Value Data Object. 'price_version' is the price table version it was saved with, to price it again with the prices it had (null if it was saved before versions were recorded).
             404:
               description: Project Not Found, it could be an error or it doesn't exists yet.
             500:
@@ -1207,6 +3509,9 @@ def get_project_prices(project_id):
             pg_dict = pricegen.to_dict()
             resp['value'] = pg_dict['value']
             resp['m2'] = pg_dict['m2']
+            price_gen_version = PriceGenVersion.query.get(pricegen.id)
+            resp['price_version'] = price_gen_version.version \
+                if price_gen_version is not None else None
             for element in pg_dict['price_value_saved']:
                 detail = element['price_value_detail'][0]
 
@@ -1215,12 +3520,9 @@ def get_project_prices(project_id):
                     category: PriceCategory = PriceCategory.query \
                         .filter(PriceCategory.id == detail['category_id']) \
                         .first()
-                    flag = False
-                    for dic in categories:
-                        if dic['name'] != category.name:
-                            flag = True
-                        else:
-                            flag = False
+                    # Each category once, it has a value for every module
+                    flag = all(dic['name'] != category.name
+                               for dic in categories)
                     if flag:
                         c['code'] = category.code
                         c['id'] = detail['category_id']
@@ -1326,11 +3628,107 @@ def get_estimated_price():
             m2:
                 type: number
                 format: float
+            currencies:
+                type: array
+                description: Optional currency codes (ISO 4217) to also get the values in
+                items:
+                    type: string
+            price_version:
+                type: integer
+                description: Optional past price table version to price with, see /api/prices/versions
+
 
 
+    """
+    # total cost in Estimador_de_costo interface
+    rates, error = get_request_rates(request.json)
+    if error is not None:
+        return error
+
+    price_version, error = get_request_price_version(request.json)
+    if error is not None:
+        return error
+    version, historic = price_version
+    headers = {PRICE_VERSION_HEADER: version}
+
+    key = estimate_cache_key('value', request.json, version)
+    resp = CACHE_MISS
+    if key is not None:
+        resp = estimates_cache.get(key, CACHE_MISS)
+    if resp is not CACHE_MISS:
+        return jsonify(convert_estimate(resp, rates) if rates else resp), \
+            200, headers
 
+    token = request.headers.get('Authorization', None)
+    estimate, error = estimate_request(
+        request.json, token, version=version, historic=historic)
+    if error is not None:
+        return error
+
+    resp = {
+        'value': estimate['value'],
+        'weeks_source': estimate['weeks_source']
+    }
+    cache_estimate(key, resp)
+    return jsonify(convert_estimate(resp, rates) if rates else resp), \
+        200, headers
+
+
+@app.route('/api/prices/batch', methods=['POST'])
+@token_required
+def get_estimated_prices_batch():
+    """
+        Get Estimated prices of many scenarios
+        ---
+
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        - "application/x-ndjson"
+        consumes:
+        - "application/json"
+        parameters:
+        - in: "body"
+          name: "body"
+          description: List of /api/prices bodies
+          required: true
+          schema:
+            type: array
+            items:
+                type: object
+                required:
+                - categories
+                - workspaces
+                - country
+                - m2
+                properties:
+                    categories:
+                        type: array
+                        items:
+                            type: object
+                    workspaces:
+                        type: array
+                        items:
+                            type: object
+                    country:
+                        type: string
+                    m2:
+                        type: number
+                        format: float
+        responses:
+            200:
+                description: "{'results': [...]} with the /api/prices response of each scenario, in order. With Accept: application/x-ndjson each response is streamed as a line instead."
+            400:
+                description: Data or missing field in body.
+            500:
+                description: Internal server error.
     """
-    # total cost in Estimador_de_costo interface
+    scenarios = request.json
+    if not isinstance(scenarios, list):
+        return jsonify({'message': 'body must be a list of scenarios'}), \
+            HTTPStatus.BAD_REQUEST
+
     # Check JSON Input
     params = {
         'categories',
@@ -1339,145 +3737,139 @@ def get_estimated_price():
         'm2'
     }
 
-    for param in params:
-        if param not in request.json:
-            logging.error(f'{param} not in body')
-            return jsonify({'message': f'{param} not in body'}), \
-                HTTPStatus.BAD_REQUEST
+    for index, scenario in enumerate(scenarios):
+        for param in params:
+            if param not in scenario:
+                logging.error(f'{param} not in scenario {index}')
+                return jsonify({'message': f'{param} not in scenario {index}'}), \
+                    HTTPStatus.BAD_REQUEST
 
+    # Get all spaces of every scenario at once.
+    token = request.headers.get('Authorization', None)
+    space_ids = {_space['space_id']
+                 for scenario in scenarios for _space in scenario['workspaces']}
     try:
-        workspaces: list = request.json['workspaces']
-        categories: list = request.json['categories']
-
+        space_modules = get_spaces_modules(space_ids, token)
     except Exception as exp:
-        logging.error(exp)
-        return {'message': f'{exp}'}, \
-            HTTPStatus.BAD_REQUEST
-
-    spaces = {}
-
-    # Get all spaces.
-    token = request.headers.get('Authorization', None)
-    for _space in workspaces:
-        try:
-            headers = {'Authorization': token}
-            resp = requests.get(
-                f'http://{SPACES_MODULE_HOST}:{SPACES_MODULE_PORT}{SPACES_MODULE_API}'
-                f'/{_space["space_id"]}', headers=headers)
-            space = json.loads(resp.content.decode('utf-8'))
-            spaces[space['id']] = space['name']
-
-        except Exception as exp:
-            logging.error(f"Error getting spaces {exp}")
-            return f"Error getting spaces {exp}", 500
-
-    # ---------------- Calc total price -------------------------
-    # Get Country id
-    country_name = request.json['country']
-    country: PriceCountry = PriceCountry.query.filter(
-        PriceCountry.name == country_name).first()
-    if country is None:
-        return f'{country_name} is a invalid country'
+        logging.error(f"Error getting spaces {exp}")
+        return f"Error getting spaces {exp}", 500
 
-    # Find prices according to space
-    space_category_prices = {}
-    # for _space in workspaces:
-    i = 0
+    results = batch_estimates(
+        scenarios, space_modules, token, get_price_table_version())
+    if wants_ndjson():
+        return ndjson_response(results)
+    return jsonify({'results': list(results)}), 200
 
-    while i < len(workspaces):
-        space_name = spaces[workspaces[i]['space_id']]
-        # Get PriceModule id
-        price_module: PriceModule = PriceModule.query.filter(
-            PriceModule.name == space_name).first()
-        if price_module is None:
-            logging.warning(f'No space name: {space_name}')
-            workspaces.remove(workspaces[i])
-            i = i-1
-        else:
-            # Get all prices and save in a map:
-            prices = PriceValue.query.filter(PriceValue.country_id == country.id) \
-                .filter(PriceValue.module_id == price_module.id)
-            category_prices = {}
-            price: PriceValue
-
-            for price in prices:
-                category_prices[price.category_id] = {
-                    'low': price.low,
-                    'normal': price.medium,
-                    'high': price.high
-                }
-
-            space_category_prices[workspaces[i]['space_id']] = category_prices
-        i = i+1
 
-    base_category_prices = {}
-    # Get all base prices and save in a map:
-    base_prices = PriceValue.query.filter(PriceValue.country_id == country.id) \
-        .filter(PriceValue.module_id == None)
-    base_price: PriceValue
-
-    for base_price in base_prices:
-        base_category_prices[base_price.category_id] = {
-            'low': base_price.low,
-            'normal': base_price.medium,
-            'high': base_price.high
-        }
-    space_category_prices[-1] = base_category_prices
+def batch_estimates(scenarios, space_modules, token, version):
+    """
+    Price each /api/prices/batch scenario, yielding its result as soon as
+    it's computed. Countries and project weeks are resolved once per
+    distinct value.
+    """
+    matrices = {}
+    project_weeks = {}
+    for scenario in scenarios:
+        country_name = scenario['country']
+        if country_name not in matrices:
+            matrices[country_name] = get_price_matrix(country_name, version)
+        matrix = matrices[country_name]
+        if matrix is None:
+            yield {'message': f'{country_name} is a invalid country'}
+            continue
+
+        m2 = scenario['m2']
+        weeks = None
+        weeks_source = None
+        if needs_project_weeks(scenario['categories']):
+            if m2 not in project_weeks:
+                project_weeks[m2] = get_project_weeks(m2, token)
+            weeks, weeks_source = project_weeks[m2]
+
+        workspaces = scenario['workspaces']
+        space_rows = get_space_rows(matrix, space_modules, workspaces)
+        estimate = estimate_prices(
+            matrix, space_rows, workspaces, scenario['categories'], m2, weeks)
+        yield {'value': estimate['value'], 'weeks_source': weeks_source}
+
+
+@app.route('/api/prices/sensitivity', methods=['POST'])
+@token_required
+def get_estimated_price_sensitivity():
+    """
+        Get the estimated price of every answer of every category
+        ---
 
-    final_value = 0
-    m2 = request.json['m2']
-    weeks = get_project_weeks(m2, token)
-    # iterate in categories and find prices
-    for category in categories:
-        cat_id = category['id']
-        cat_resp = category['resp']
-        cat_name = category['name']
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        consumes:
+        - "application/json"
+        parameters:
+        - in: "body"
+          name: "body"
+          description: Same body as /api/prices
+          required:
+          - categories
+          - workspaces
+          - country
+          - m2
+          properties:
+            categories:
+                type: array
+                items:
+                    type: object
+            workspaces:
+                type: array
+                items:
+                    type: object
+            country:
+                type: string
+            m2:
+                type: number
+                format: float
+            price_version:
+                type: integer
+                description: Optional past price table version to price with
+        responses:
+            200:
+                description: Current total and, for each category, the total if it were answered low, normal or high with the other answers unchanged.
+            400:
+                description: Data or missing field in body.
+            500:
+                description: Internal server error.
+    """
+    price_version, error = get_request_price_version(request.json)
+    if error is not None:
+        return error
+    version, historic = price_version
 
-        if category['code'] != 'BASE':
-            for _space in workspaces:
-                space_id = _space['space_id']
-                if space_id in space_category_prices:
-                    final_value += (space_category_prices[space_id]
-                                    [cat_id][cat_resp]) * _space['quantity']
-                else:
-                    logging.warning(
-                        f"Not valid space_id: {_space['space_id']}")
-        else:
-            calc_type = ''
-            div_factor = 1
-            if cat_name in constants.BASES_CALC:
-                calc_type = constants.BASES_CALC[cat_name]
-                calc_type = calc_type.split('/')
-                if len(calc_type) > 1:
-                    div_factor = float(calc_type[1])
-                calc_type = calc_type[0]
-
-            if calc_type == 'm2':
-                final_value += (space_category_prices[-1]
-                                [cat_id][cat_resp]*(m2/div_factor))
-            elif calc_type == 'weeks':
-                final_value += (space_category_prices[-1]
-                                [cat_id][cat_resp]*weeks)
-            else:
-                final_value += (space_category_prices[-1]
-                                [cat_id][cat_resp])
+    token = request.headers.get('Authorization', None)
+    estimate, error = estimate_request(
+        request.json, token, version=version, historic=historic)
+    if error is not None:
+        return error
 
-    price_design: PriceDesign = PriceDesign.query.filter(
-        PriceDesign.country_id == country.id).first()
+    # Swap the answered value of each category for each level's value.
+    current = np.array(estimate['category_values'])
+    totals = estimate['value'] - current[:, np.newaxis] + estimate['level_values']
 
-    if price_design is not None:
-        if m2 < 100:
-            final_value += price_design.category_1
-        elif 100 <= m2 < 500:
-            final_value += price_design.category_2
-        elif 500 <= m2 < 1000:
-            final_value += price_design.category_3
-        elif 1000 <= m2 < 2500:
-            final_value += price_design.category_4
-        else:
-            final_value += price_design.category_5
+    categories = []
+    for category, category_totals in zip(request.json['categories'], totals):
+        categories.append({
+            'id': category['id'],
+            'code': category['code'],
+            'name': category['name'],
+            'resp': category['resp'],
+            'values': dict(zip(PRICE_LEVELS, category_totals.tolist()))
+        })
 
-    return jsonify({'value': final_value}), 200
+    return jsonify({
+        'value': estimate['value'],
+        'weeks_source': estimate['weeks_source'],
+        'categories': categories
+    }), 200, {PRICE_VERSION_HEADER: version}
 
 
 @app.route('/api/prices/detail', methods=['POST'])
@@ -1548,217 +3940,146 @@ def get_estimated_price_detail():
             m2:
                 type: number
                 format: float
+            currencies:
+                type: array
+                description: Optional currency codes (ISO 4217) to also get the values in
+                items:
+                    type: string
+            price_version:
+                type: integer
+                description: Optional past price table version to price with, see /api/prices/versions
     """
-    # Check JSON Input
-    params = {
-        'categories',
-        'workspaces',
-        'country',
-        'm2'
-    }
-
-    for param in params:
-        if param not in request.json:
-            logging.error(f'{param} not in body')
-            return jsonify({'message': f'{param} not in body'}), \
-                HTTPStatus.BAD_REQUEST
-
-    try:
-        workspaces: list = request.json['workspaces']
-        categories: list = request.json['categories']
-
-    except Exception as exp:
-        logging.error(exp)
-        return {'message': f'{exp}'}, \
-            HTTPStatus.BAD_REQUEST
-
-    spaces = {}
+    rates, error = get_request_rates(request.json)
+    if error is not None:
+        return error
+
+    price_version, error = get_request_price_version(request.json)
+    if error is not None:
+        return error
+    version, historic = price_version
+
+    key = estimate_cache_key('detail', request.json, version)
+    resp = CACHE_MISS
+    if key is not None:
+        resp = estimates_cache.get(key, CACHE_MISS)
+    if resp is not CACHE_MISS:
+        return detail_response(resp, version, rates)
 
-    # Get all spaces.
     token = request.headers.get('Authorization', None)
-    for _space in workspaces:
-        try:
-            headers = {'Authorization': token}
-            resp = requests.get(
-                f'http://{SPACES_MODULE_HOST}:{SPACES_MODULE_PORT}{SPACES_MODULE_API}'
-                f'/{_space["space_id"]}', headers=headers)
-            space = json.loads(resp.content.decode('utf-8'))
-            spaces[space['id']] = space['name']
+    estimate, error = estimate_request(
+        request.json, token, with_weeks=True, version=version,
+        historic=historic)
+    if error is not None:
+        return error
 
-        except Exception as exp:
-            logging.error(f"Error getting spaces {exp}")
-            return f"Error getting spaces {exp}", 500
-
-    # ---------------- Calc total price -------------------------
-    # Get Country id
     country_name = request.json['country']
-    country: PriceCountry = PriceCountry.query.filter(
-        PriceCountry.name == country_name).first()
-    if country is None:
-        return f'{country_name} is a invalid country'
-
-    # Find prices according to space
-    space_category_prices = {}
-    # for _space in workspaces:
-    i = 0
-    while i < len(workspaces):
-        space_name = spaces[workspaces[i]['space_id']]
-        # Get PriceModule id
-        price_module: PriceModule = PriceModule.query.filter(
-            PriceModule.name == space_name).first()
-        if price_module is None:
-            logging.warning(f'No space name: {space_name}')
-            workspaces.remove(workspaces[i])
-            i = i-1
-        else:
-            # Get all prices and save in a map:
-            prices = PriceValue.query.filter(PriceValue.country_id == country.id) \
-                .filter(PriceValue.module_id == price_module.id)
-            category_prices = {}
-            price: PriceValue
-
-            for price in prices:
-                category_prices[price.category_id] = {
-                    'low': price.low,
-                    'normal': price.medium,
-                    'high': price.high
-                }
-
-            space_category_prices[workspaces[i]['space_id']] = category_prices
-        i = i+1
-
-    base_category_prices = {}
-    # Get all base prices and save in a map:
-    base_prices = PriceValue.query.filter(PriceValue.country_id == country.id) \
-        .filter(PriceValue.module_id == None)
-    base_price: PriceValue
-
-    for base_price in base_prices:
-        base_category_prices[base_price.category_id] = {
-            'low': base_price.low,
-            'normal': base_price.medium,
-            'high': base_price.high
-        }
-    space_category_prices[-1] = base_category_prices
-
-    final_value = 0
     m2 = request.json['m2']
-    weeks = get_project_weeks(m2, token)
-
-    # iterate in categories and find prices
-    for category in categories:
-        cat_id = category['id']
-        cat_resp = category['resp']
-        cat_name = category['name']
-        cat_obj = PriceCategory.query.filter(
-            PriceCategory.name == category['name']).first()
-        cat_subcategories = cat_obj.subcategories
-        category['subcategories'] = []
-        cat_value = 0
-        if cat_subcategories:
-            for subcat in cat_subcategories:
-                subcat_dict = subcat.to_dict()
-                subcat_dict['value'] = 0
-                subcat_dict['resp'] = cat_resp
-                if(category['code'] == 'BASE'):
-                    category['subcategories'].append(subcat_dict)
-
-        if category['code'] != 'BASE':
-            for _space in workspaces:
-                space_id = _space['space_id']
-                if space_id in space_category_prices:
-                    cat_value += (space_category_prices[space_id]
-                                  [cat_id][cat_resp]) * _space['quantity']
-                    final_value += cat_value
-                    category['value'] = cat_value
-                    if cat_subcategories:
-                        for subcat in category['subcategories']:
-                            subcat['value'] += (space_category_prices[space_id]
-                                                [subcat['id']][cat_resp]) * _space['quantity']
-                else:
-                    logging.warning(
-                        f"Not valid space_id: {_space['space_id']}")
-        else:
-            calc_type = ''
-            div_factor = 1
-            if cat_name in constants.BASES_CALC:
-                calc_type = constants.BASES_CALC[cat_name]
-                calc_type = calc_type.split('/')
-                if len(calc_type) > 1:
-                    div_factor = float(calc_type[1])
-                calc_type = calc_type[0]
-
-            if calc_type == 'm2':
-                cat_value = (space_category_prices[-1]
-                             [cat_id][cat_resp]*(m2/div_factor))
-                category['value'] = cat_value
-                final_value += cat_value
-                if cat_subcategories:
-                    for subcat in category['subcategories']:
-                        subcat['value'] += (space_category_prices[-1]
-                                            [subcat['id']][cat_resp]*(m2/div_factor))
-            elif calc_type == 'weeks':
-                cat_value = (space_category_prices[-1]
-                             [cat_id][cat_resp]*weeks)
-                category['value'] = cat_value
-                final_value += cat_value
-                if cat_subcategories:
-                    for subcat in category['subcategories']:
-                        subcat['value'] += (space_category_prices[-1]
-                                            [subcat['id']][cat_resp]*weeks)
-            else:
-                cat_value = (space_category_prices[-1]
-                             [cat_id][cat_resp])
-                category['value'] = cat_value
-                final_value += cat_value
-                if cat_subcategories:
-                    for subcat in category['subcategories']:
-                        subcat['value'] += (space_category_prices[-1]
-                                            [subcat['id']][cat_resp])
-
-    # do a filter if de value in category is zero
-    cat_tmp = []
-    for category in categories:
-        if category['value'] > 0:
-            cat_tmp.append(category)
-
-    categories = cat_tmp
+    weeks = estimate['weeks']
+    matrix = estimate['matrix']
+    tree = get_category_tree(None if historic else version)
+    categories = detail_categories(request.json['categories'], estimate, tree)
 
     # getting prices design
     design = {}
     design['name'] = 'COSTOS DISENO'
-
-    pd = PriceDesign.query.filter(
-        PriceDesign.country_id == country.id) .first()
-
-    design['value'] = 0
-    design['id'] = None
-
-    if pd is not None:
-        design['id'] = pd.id
-
-        if m2 < 100:
-            design['value'] = pd.category_1
-        elif 100 <= m2 < 500:
-            design['value'] = pd.category_2
-        elif 500 <= m2 < 1000:
-            design['value'] = pd.category_3
-        elif 1000 <= m2 < 2500:
-            design['value'] = pd.category_4
-        else:
-            design['value'] = pd.category_5
-
-        final_value += design['value']
+    design['value'] = estimate['design_value']
+    design['id'] = matrix.design_id
 
     resp = {
         'categories': categories,
         'design': design,
-        'value': final_value,
+        'value': estimate['value'],
         'country': country_name,
         'm2': m2,
-        'weeks': weeks
+        'weeks': weeks,
+        'weeks_source': estimate['weeks_source']
     }
-    return jsonify(resp), 200
+    return detail_response(resp, version, rates, key)
+
+
+def detail_categories(categories, estimate, tree):
+    """
+    Build the categories of an /api/prices/detail response, with the
+    subcategories of the base ones. Categories valued 0 are left out.
+    categories: categories of the request
+    estimate: estimate_request result of the request
+    tree: CategoryTree of the estimate's price version
+    """
+    detail = []
+    for category, cat_value, subcat_values in zip(
+            categories, estimate['category_values'],
+            estimate['subcategory_values']):
+        # do a filter if de value in category is zero
+        if cat_value <= 0:
+            continue
+
+        category['value'] = cat_value
+        category['subcategories'] = []
+        # Only base categories are detailed by subcategory
+        if category['code'] == 'BASE':
+            cat_obj = tree.by_name.get(category['name'])
+            cat_subcategories = tree.children.get(cat_obj['id'], []) \
+                if cat_obj is not None else []
+            for subcat in cat_subcategories:
+                subcat_dict = dict(subcat)
+                subcat_dict['value'] = subcat_values.get(subcat['id'], 0)
+                subcat_dict['resp'] = category['resp']
+                category['subcategories'].append(subcat_dict)
+        detail.append(category)
+    return detail
+
+
+def detail_response(resp, version, rates=None, key=None):
+    """
+    Respond an /api/prices/detail response.
+    resp: response in USD
+    version: PriceTableVersion the response is priced with
+    rates: optional exchange rates to also convert the values with
+    key: estimates_cache key to store the response in
+    """
+    cache_estimate(key, resp)
+    if rates:
+        resp = convert_estimate(resp, rates)
+    return jsonify(resp), 200, {PRICE_VERSION_HEADER: version}
+
+
+@app.route('/api/prices/cache', methods=['GET'])
+@token_required
+def get_caches_stats():
+    """
+        Get the size and hit/miss counters of the service caches
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        responses:
+            200:
+              description: Stats of each cache
+    """
+    return jsonify({
+        'spaces': spaces_modules_cache.stats(),
+        'weeks': project_weeks_cache.stats(),
+        'estimates': estimates_cache.stats(),
+        'price_versions': historic_price_matrices.stats()
+    }), 200
+
+
+@app.route('/api/prices/cache/spaces', methods=['DELETE'])
+@token_required
+def purge_spaces_cache():
+    """
+        Purge the cache of space id -> price module
+        ---
+        tags:
+        - "Prices"
+        produces:
+        - "application/json"
+        responses:
+            200:
+              description: Number of entries removed
+    """
+    return jsonify({'purged': spaces_modules_cache.purge()}), 200
 
 
 
@@ -1779,7 +4100,7 @@ def get_currencies():
               description: Database or Internal Server error
     """
 
-    rv = requests.get(EXCHANGE_CURRENCY_URL)
+    rv = downstream.get(EXCHANGE_CURRENCY_URL)
     if rv.status_code == 200:
         return json.loads(rv.text), 200
 
@@ -1802,7 +4123,7 @@ def update_exchanges():
         # Verify remaining requests
         ###########################
 
-        rv_account_state = requests.get(EXCHANGE_STATE_URL)
+        rv_account_state = downstream.get(EXCHANGE_STATE_URL)
         account_state = json.loads(rv_account_state.text)
 
         remaining = account_state["data"]["usage"]["requests_remaining"]
@@ -1813,7 +4134,7 @@ def update_exchanges():
         # Grab data, update table
         #########################
 
-        rv_exchange_rates = requests.get(EXCHANGE_RATE_URL)
+        rv_exchange_rates = downstream.get(EXCHANGE_RATE_URL)
         exchange_rates = json.loads(rv_exchange_rates.text)
 
         new_rates = exchange_rates["rates"]
@@ -1839,18 +4160,18 @@ def update_exchanges():
 
                 db.session.add(new_item)
 
+        exchange_state = ExchangeRateTimeStamp.query.get(1)
+        if exchange_state is not None:
+            exchange_state.lastUpdate = dt.datetime.now()
+
         db.session.commit()
 
     except:
         raise
 
 
-def get_exchange_rate_by_code(code: str):
-    """
-
-    Returns:
-    - float > 0: the correct rate
-    - -1: the code is invalid
+def refresh_exchange_rates():
+    """Update ExchangeRates if the day is over or if there is no data.
 
     Exception Management:
     - Exception: Problems with database.
@@ -1890,15 +4211,150 @@ def get_exchange_rate_by_code(code: str):
         # unbounds errors.
         raise
 
-    # Grab the data
-    ###############
+
+# Rates of the day in memory: (date, {currency code: rate with base USD})
+_exchange_rates = None
+_exchange_rates_lock = threading.Lock()
+# If a thread is loading the rates of the day, guarded by the lock
+_exchange_rates_loading = False
+
+
+def load_stored_exchange_rates():
+    """
+    Get the rates stored in ExchangeRates, with base USD.
+
+    Exception Management:
+    - Exception: There are no rates stored.
+    """
+    rates = {rate.id: rate.rate for rate in ExchangeRates.query.all()}
+    if not rates:
+        raise Exception("There are no exchange rates")
+    return rates
+
+
+def get_exchange_rates():
+    """
+    Get the exchange rates of the day, with base USD. They are loaded once a
+    day per worker, updating ExchangeRates first if needed. If the update
+    fails the stored rates are used until the next day.
+    Only one thread loads them, without holding the lock during the update.
+    Meanwhile the others use the previous rates: the ones in memory or, if
+    there are none yet, the stored ones.
+
+    Exception Management:
+    - Exception: There are no rates to use.
+    """
+    global _exchange_rates, _exchange_rates_loading
+    today = dt.date.today()
+    exchange_rates = _exchange_rates
+    if exchange_rates is not None and exchange_rates[0] == today:
+        return exchange_rates[1]
+
+    with _exchange_rates_lock:
+        loading = _exchange_rates_loading
+        _exchange_rates_loading = True
+    if loading:
+        if exchange_rates is not None:
+            return exchange_rates[1]
+        return load_stored_exchange_rates()
+
+    try:
+        try:
+            refresh_exchange_rates()
+        except Exception as e:
+            logging.error(f'Error updating exchange rates: {e}')
+            db.session.rollback()
+        try:
+            rates = load_stored_exchange_rates()
+        except Exception:
+            if exchange_rates is None:
+                raise
+            logging.error('Can\'t load the exchange rates, using the '
+                          'previous ones')
+            return exchange_rates[1]
+        with _exchange_rates_lock:
+            _exchange_rates = (today, rates)
+        return rates
+    finally:
+        with _exchange_rates_lock:
+            _exchange_rates_loading = False
+
+
+def get_exchange_rate_by_code(code: str):
+    """
+
+    Returns:
+    - float > 0: the correct rate
+    - -1: the code is invalid
+
+    Exception Management:
+    - Exception: There are no rates to use.
+    """
+    return get_exchange_rates().get(code.upper(), -1)
+
+
+def get_request_rates(body):
+    """
+    Exchange rates of the optional 'currencies' list of an estimate body.
+    Returns (rates, None) or (None, error response). rates is None if no
+    currency is requested.
+    """
+    currencies = body.get('currencies') if isinstance(body, dict) else None
+    if not currencies:
+        return None, None
+    if not isinstance(currencies, list):
+        return None, ({'message': 'currencies must be a list'},
+                      HTTPStatus.BAD_REQUEST)
 
     try:
-        exchange_rate = ExchangeRates.query.get(code)
-        return exchange_rate.rate
+        rates = get_exchange_rates()
+    except Exception as e:
+        logging.error(e)
+        return None, (f"Internal error: {e}", 500)
+
+    requested = {}
+    for code in currencies:
+        code = str(code).upper()
+        if code not in rates:
+            return None, (f"Code {code} is not valid", 404)
+        requested[code] = rates[code]
+    return requested, None
+
+
+def convert_estimate(resp, rates):
+    """
+    Copy of an /api/prices or /api/prices/detail response with its values in
+    USD converted with rates. Adds 'rates' and 'converted' ({code: value}) to
+    the response, and 'converted' to each category, subcategory and design.
+    """
+    resp = dict(resp, rates=rates, converted=convert_value(resp['value'], rates))
+    if 'categories' in resp:
+        resp['categories'] = [convert_category(category, rates)
+                              for category in resp['categories']]
+        resp['design'] = dict(
+            resp['design'],
+            converted=convert_value(resp['design']['value'], rates))
+    return resp
+
+
+def convert_category(category, rates):
+    """
+    Copy of an /api/prices/detail category with 'converted' ({code: value})
+    added to it and its subcategories.
+    """
+    return dict(category,
+                converted=convert_value(category['value'], rates),
+                subcategories=[
+                    dict(subcat,
+                         converted=convert_value(subcat['value'], rates))
+                    for subcat in category['subcategories']])
+
 
-    except AttributeError:
-        return -1
+def convert_value(value, rates):
+    """
+    {code: value} of a value in USD converted with rates.
+    """
+    return {code: value * rate for code, rate in rates.items()}
 
 
 @app.route('/api/prices/exchange/<currency_code>', methods=['GET'])
@@ -1,12 +1,30 @@
 import unittest
 import os
+import concurrent.futures
+import datetime as dt
+import time
 from http import HTTPStatus
 from io import BytesIO
 import json
 import jwt
+from unittest import mock
 from main import PriceGen, PriceValue, \
     PriceCategory, PriceCountry, PriceModule, \
-    db, app
+    TTLCache, CACHE_MISS, db, app, validate_prices_sheet, get_price_matrix, \
+    get_spaces_modules, spaces_modules_cache, get_space, get_spaces_names, \
+    ExchangeRates, get_exchange_rates, PriceMatrix, publish_price_version, \
+    reload_price_matrices, invalidate_category_tree, estimates_cache, \
+    get_category_tree, get_project_weeks, project_weeks_cache, \
+    CircuitBreaker, DownstreamSession, project_weeks_fallback, \
+    estimate_project_weeks, DB_POOL_SIZE, DB_MAX_OVERFLOW, \
+    read_workbook_sheets, parse_prices_sheet, PRICE_SHEET_COLUMNS, \
+    read_sheet, read_excel_sheets, PriceUploadJob, import_prices_workbook
+import numpy as np
+import openpyxl
+import pandas as pd
+import requests
+import sqlalchemy
+import threading
 
 
 class MyTestCase(unittest.TestCase):
@@ -28,7 +46,7 @@ class MyTestCase(unittest.TestCase):
             "jti": "450ca670aff83b220d8fd58d9584365614fceaf210c8db2cf4754864318b5a398cf625071993680d",
             "iat": 1592309117,
             "nbf": 1592309117,
-            "exp": 1624225038,
+            "exp": int(time.time()) + 3600,
             "sub": "23",
             "user_id": user_id,
             "scopes": [],
@@ -60,6 +78,854 @@ class MyTestCase(unittest.TestCase):
                 self.assertEqual(rv.status_code, HTTPStatus.OK)
                 return rv
 
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b', CACHE_MISS))
+        cache.set('c', 3)
+        # 'a' is the least recently used entry
+        self.assertIs(cache.get('a', CACHE_MISS), CACHE_MISS)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        cache.ttl = -1
+        cache.set('d', 4)
+        self.assertIs(cache.get('d', CACHE_MISS), CACHE_MISS)
+        self.assertEqual(cache.purge(), 1)
+
+    def test_spaces_modules_cache(self):
+        db.create_all()
+        db.session.commit()
+        spaces_modules_cache.purge()
+        with mock.patch('main.get_spaces_names',
+                        return_value={1: 'CACHED_SPACE'}) as get_names:
+            # A space without a module isn't cached
+            self.assertEqual(get_spaces_modules([1], 'token'), {1: None})
+            module = PriceModule(name='CACHED_SPACE')
+            db.session.add(module)
+            db.session.commit()
+            self.assertEqual(get_spaces_modules([1], 'token'), {1: module.id})
+            self.assertEqual(get_spaces_modules([1], 'token'), {1: module.id})
+            self.assertEqual(get_names.call_count, 2)
+        spaces_modules_cache.purge()
+
+    def test_space_deadline(self):
+        unavailable = mock.Mock(status_code=503)
+        answer = mock.Mock(status_code=200, content=b'{"id": 1, "name": "A"}')
+        with mock.patch('main.spaces_session') as session:
+            session.get.side_effect = [unavailable, answer]
+            deadline = time.monotonic() + 5
+            self.assertEqual(get_space(1, 'token', deadline)['name'], 'A')
+            # No attempt waits past the deadline
+            for call in session.get.call_args_list:
+                self.assertLessEqual(call.kwargs['timeout'][1], 5)
+
+            session.get.reset_mock(side_effect=True)
+            session.get.side_effect = requests.Timeout
+            with self.assertRaises(Exception):
+                get_space(1, 'token', time.monotonic())
+            session.get.assert_not_called()
+
+    def test_spaces_names(self):
+        def space(url, **kwargs):
+            space_id = int(url.rsplit('/', 1)[-1])
+            return mock.Mock(status_code=200, content=json.dumps(
+                {'id': space_id, 'name': f'SPACE {space_id}'}).encode())
+
+        with mock.patch('main.spaces_session') as session:
+            session.get.side_effect = space
+            self.assertEqual(get_spaces_names([1, 2, 1, 1], 'token'),
+                             {1: 'SPACE 1', 2: 'SPACE 2'})
+            # Each distinct space is requested once
+            self.assertEqual(session.get.call_count, 2)
+
+    def test_exchange_rates_refresh(self):
+        db.create_all()
+        db.session.merge(ExchangeRates(id='CLP', rate=900.0))
+        db.session.commit()
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_refresh():
+            started.set()
+            release.wait(5)
+
+        with mock.patch('main._exchange_rates', None), \
+                mock.patch('main.refresh_exchange_rates',
+                           side_effect=slow_refresh) as refresh:
+            loader = threading.Thread(target=get_exchange_rates)
+            loader.start()
+            self.assertTrue(started.wait(5))
+            # Served the stored rates without waiting for the refresh
+            self.assertEqual(get_exchange_rates(), {'CLP': 900.0})
+            release.set()
+            loader.join()
+            self.assertEqual(get_exchange_rates(), {'CLP': 900.0})
+            self.assertEqual(refresh.call_count, 1)
+
+    def test_validate_prices_sheet(self):
+        # Indexed by row number in the sheet, rows 4 and 5 are empty
+        sheet = pd.DataFrame({
+            'PRE': ['BASE', 'A01', 'A01', 'A01'],
+            'MODULO': ['DEMOLICION', 'WYS_SALA', None, 'WYS_SALA'],
+            'PARAMETRO': [None, 'MOBILIARIO (M2', 'MOBILIARIO', 'MOBILIARIO (M2'],
+            'DETALLE': [None, 'Obra Civil', None, 'Obra Civil'],
+            'ESTANDAR BAJO': [1, 'x', 3, 4],
+            'ESTANDAR MEDIO': [1, 2, 3, 4],
+            'ESTANDAR ALTO': [1, 2, None, 4]
+        }, index=[2, 3, 6, 7])
+        errors = validate_prices_sheet(sheet)
+        self.assertEqual(len(errors), 4)
+        self.assertIn('rows [6] have no module', errors)
+        self.assertIn('ESTANDAR BAJO of rows [3] is not a number', errors)
+        self.assertIn('rows [3, 7] repeat the same module, category and detail',
+                      errors)
+        self.assertEqual(validate_prices_sheet(sheet.drop(columns='DETALLE')),
+                         ["columns ['DETALLE'] not found"])
+        self.assertEqual(validate_prices_sheet(sheet.iloc[[0]]), [])
+
+    @staticmethod
+    def seed_estimate_prices():
+        """
+        Publish the prices of TESTLAND: MOBILIARIO for the modules of spaces
+        1 and 2, and the base PROJECT MANAGER, priced by weeks, with its
+        subcategory PM SENIOR.
+        Returns the /api/prices body and the module of each space.
+        """
+        country = PriceCountry(name='TESTLAND')
+        sala = PriceModule(name='SALA')
+        oficina = PriceModule(name='OFICINA')
+        mobiliario = PriceCategory(code='MOBILIARIO', name='MOBILIARIO',
+                                   type='A')
+        manager = PriceCategory(code='BASE', name='PROJECT MANAGER', type='A')
+        db.session.add_all([country, sala, oficina, mobiliario, manager])
+        db.session.flush()
+        senior = PriceCategory(code='BASE', name='PM SENIOR', type='A',
+                               parent_category_id=manager.id)
+        db.session.add(senior)
+        db.session.flush()
+        db.session.add_all([
+            PriceValue(country_id=country.id, module_id=sala.id,
+                       category_id=mobiliario.id, low=10, medium=20, high=30),
+            PriceValue(country_id=country.id, module_id=oficina.id,
+                       category_id=mobiliario.id, low=1, medium=2, high=3),
+            PriceValue(country_id=country.id, category_id=manager.id,
+                       low=100, medium=200, high=300),
+            PriceValue(country_id=country.id, category_id=senior.id,
+                       low=40, medium=50, high=60)])
+        version = publish_price_version([country.id], 'upload')
+        # Other tests may have left their TESTLAND cached
+        invalidate_category_tree()
+        reload_price_matrices(['TESTLAND'], version)
+        estimates_cache.purge()
+
+        body = {
+            'country': 'TESTLAND',
+            'm2': 50,
+            'workspaces': [{'id': 1, 'space_id': 1, 'quantity': 2},
+                           {'id': 2, 'space_id': 2, 'quantity': 3},
+                           {'id': 3, 'space_id': 1, 'quantity': 1}],
+            'categories': [dict(mobiliario.to_dict(), resp='normal'),
+                           dict(manager.to_dict(), resp='high')]
+        }
+        return body, {1: sala.id, 2: oficina.id}
+
+    def test_price_matrix(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        matrix = get_price_matrix('TESTLAND')
+        self.assertIs(get_price_matrix('testland'), matrix)
+        for value in PriceValue.query.all():
+            row = PriceMatrix.BASE_ROW if value.module_id is None \
+                else matrix.module_rows[value.module_id]
+            self.assertEqual(matrix.price(row, value.category_id, 'normal'),
+                             value.medium)
+
+        # The total is the sum of the price of each workspace's space
+        mobiliario, manager = body['categories']
+        expected = sum(
+            workspace['quantity'] * PriceValue.query.filter(
+                PriceValue.module_id == space_modules[workspace['space_id']],
+                PriceValue.category_id == mobiliario['id']).one().medium
+            for workspace in body['workspaces'])
+        expected += 7 * PriceValue.query.filter(
+            PriceValue.category_id == manager['id']).one().high
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = client.post('/api/prices', json=body)
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            self.assertEqual(rv.get_json()['value'], expected)
+
+    def test_batch_estimates(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        scenarios = [body,
+                     dict(body, m2=80, categories=[
+                         dict(body['categories'][0], resp='low')]),
+                     dict(body, country='NOWHERE')]
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules) as get_modules, \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = client.post('/api/prices/batch', json=scenarios)
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            results = rv.get_json()['results']
+            # The spaces of every scenario are resolved at once
+            self.assertEqual(get_modules.call_count, 1)
+
+            for scenario, result in zip(scenarios[:2], results):
+                single = client.post('/api/prices', json=scenario).get_json()
+                self.assertEqual(result['value'], single['value'])
+            self.assertEqual(results[1]['value'], 3 * 10 + 3 * 1)
+            self.assertEqual(results[2],
+                             {'message': 'NOWHERE is a invalid country'})
+
+    def test_detail_matches_total(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            total = client.post('/api/prices', json=body).get_json()
+            detail = client.post('/api/prices/detail', json=body).get_json()
+        self.assertEqual(detail['value'], total['value'])
+        self.assertEqual(sum(category['value']
+                             for category in detail['categories']) +
+                         detail['design']['value'], total['value'])
+        self.assertEqual(detail['weeks'], 7)
+
+    def test_category_tree(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        tree = get_category_tree()
+        self.assertIs(get_category_tree(), tree)
+        manager = body['categories'][1]
+        self.assertEqual([subcategory['name'] for subcategory
+                          in tree.children[manager['id']]], ['PM SENIOR'])
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            sqlalchemy.event.listen(db.engine, 'before_cursor_execute',
+                                    count_statement)
+            try:
+                detail = client.post('/api/prices/detail', json=body).get_json()
+            finally:
+                sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                        count_statement)
+        # The categories come from the tree, not from a query each
+        self.assertTrue(statements)
+        self.assertFalse([statement for statement in statements
+                          if 'FROM price_category' in statement])
+        subcategories = detail['categories'][1]['subcategories']
+        self.assertEqual([(subcategory['name'], subcategory['value'])
+                          for subcategory in subcategories],
+                         [('PM SENIOR', 60 * 7)])
+
+        # New categories are seen once the tree is invalidated
+        db.session.add(PriceCategory(code='BASE', name='PM JUNIOR', type='A',
+                                     parent_category_id=manager['id']))
+        db.session.commit()
+        invalidate_category_tree()
+        self.assertEqual(len(get_category_tree().children[manager['id']]), 2)
+
+    def test_sensitivity(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = client.post('/api/prices/sensitivity', json=body)
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            sensitivity = rv.get_json()
+
+            # Each value is the total with only that answer changed
+            for i, category in enumerate(body['categories']):
+                values = sensitivity['categories'][i]['values']
+                for level in ('low', 'normal', 'high'):
+                    categories = [dict(other, resp=level) if j == i else other
+                                  for j, other in enumerate(body['categories'])]
+                    total = client.post('/api/prices', json=dict(
+                        body, categories=categories)).get_json()['value']
+                    self.assertEqual(values[level], total)
+        self.assertEqual(sensitivity['categories'][0]['values']['low'],
+                         3 * 10 + 3 * 1 + 300 * 7)
+
+    def test_project_weeks_cache(self):
+        project_weeks_cache.purge()
+        with mock.patch('main.request_project_weeks',
+                        return_value=12) as request_weeks, \
+                mock.patch('main.times_circuit', CircuitBreaker(3, 60)):
+            self.assertEqual(get_project_weeks(321, 'token'), (12, 'times'))
+            self.assertEqual(get_project_weeks(321, 'token'), (12, 'times'))
+            self.assertEqual(request_weeks.call_count, 1)
+            get_project_weeks(654, 'token')
+            self.assertEqual(request_weeks.call_count, 2)
+        project_weeks_cache.purge()
+
+        # Only requested if a category is priced by weeks
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')) as get_weeks:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            client.post('/api/prices', json=dict(
+                body, categories=body['categories'][:1]))
+            get_weeks.assert_not_called()
+            client.post('/api/prices', json=body)
+            get_weeks.assert_called_once()
+
+    def test_downstream_session(self):
+        session = DownstreamSession(timeout=(1, 5), pool_size=4, retries=2,
+                                    backoff=0.1)
+        adapter = session.get_adapter('http://spaces/api/spaces/1')
+        self.assertIs(session.get_adapter('http://times/api'), adapter)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+        with mock.patch('requests.Session.request') as request:
+            session.get('http://spaces/api/spaces/1')
+            self.assertEqual(request.call_args.kwargs['timeout'], (1, 5))
+            session.get('http://spaces/api/spaces/1', timeout=(1, 2))
+            self.assertEqual(request.call_args.kwargs['timeout'], (1, 2))
+
+    def test_times_circuit(self):
+        circuit = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        circuit.failure()
+        self.assertTrue(circuit.allow())
+        circuit.failure()
+        self.assertFalse(circuit.allow())
+        # Half open once the reset timeout is over
+        circuit.reset_timeout = 0
+        self.assertTrue(circuit.allow())
+        self.assertFalse(circuit.allow())
+        circuit.success()
+        self.assertEqual(circuit.state, CircuitBreaker.CLOSED)
+
+        project_weeks_cache.purge()
+        project_weeks_fallback.purge()
+        with mock.patch('main.times_circuit', CircuitBreaker(2, 60)), \
+                mock.patch('main.request_project_weeks',
+                           return_value=9) as request_weeks:
+            self.assertEqual(get_project_weeks(300, 'token'), (9, 'times'))
+            project_weeks_cache.purge()
+            request_weeks.side_effect = Exception('times is down')
+            self.assertEqual(get_project_weeks(300, 'token'), (9, 'cache'))
+            self.assertEqual(get_project_weeks(400, 'token'),
+                             (estimate_project_weeks(400), 'estimate'))
+            # The circuit is open, the times uservice isn't called
+            get_project_weeks(500, 'token')
+            self.assertEqual(request_weeks.call_count, 3)
+        project_weeks_fallback.purge()
+
+    def test_concurrent_estimate_io(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        # Each call waits for the other, so they must run at once
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_modules(*args):
+            barrier.wait()
+            return space_modules
+
+        def get_weeks(*args):
+            barrier.wait()
+            return 7, 'times'
+
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules', side_effect=get_modules), \
+                mock.patch('main.get_project_weeks', side_effect=get_weeks):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = client.post('/api/prices', json=body)
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+
+        # MySQL engines get a pool for the request threads
+        options = {}
+        db.apply_driver_hacks(app, sqlalchemy.engine.make_url(
+            'mysql+pymysql://user@localhost/prices'), options)
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (DB_POOL_SIZE, DB_MAX_OVERFLOW))
+
+    def test_estimates_cache(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        reordered = dict(body, workspaces=body['workspaces'][::-1])
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')) as get_weeks:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            first = client.post('/api/prices', json=body).get_json()
+            # Same request, with the workspaces in another order
+            self.assertEqual(
+                client.post('/api/prices', json=reordered).get_json(), first)
+            self.assertEqual(get_weeks.call_count, 1)
+
+            # A new price version isn't served from the cache
+            country = PriceCountry.query.filter(
+                PriceCountry.name == 'TESTLAND').one()
+            publish_price_version([country.id], 'upload')
+            client.post('/api/prices', json=body)
+            self.assertEqual(get_weeks.call_count, 2)
+
+            # Nor are the fallback weeks of a failing times uservice
+            get_weeks.return_value = (7, 'estimate')
+            client.post('/api/prices', json=dict(body, m2=60))
+            client.post('/api/prices', json=dict(body, m2=60))
+            self.assertEqual(get_weeks.call_count, 4)
+
+    def test_currency_conversion(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        body['currencies'] = ['clp', 'EUR']
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')), \
+                mock.patch('main.get_exchange_rates',
+                           return_value={'CLP': 900.0, 'EUR': 0.5}):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            total = client.post('/api/prices', json=body).get_json()
+            self.assertEqual(total['converted'], {'CLP': total['value'] * 900,
+                                                  'EUR': total['value'] * 0.5})
+
+            detail = client.post('/api/prices/detail', json=body).get_json()
+            for category in detail['categories']:
+                self.assertEqual(category['converted']['CLP'],
+                                 category['value'] * 900)
+                for subcategory in category['subcategories']:
+                    self.assertEqual(subcategory['converted']['EUR'],
+                                     subcategory['value'] * 0.5)
+
+            rv = client.post('/api/prices', json=dict(body, currencies=['XXX']))
+            self.assertEqual(rv.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_batch_ndjson(self):
+        db.create_all()
+        db.session.commit()
+        body, space_modules = self.seed_estimate_prices()
+        scenarios = [body, dict(body, country='NOWHERE'), dict(body, m2=80)]
+        with app.test_client() as client, \
+                mock.patch('main.get_spaces_modules',
+                           return_value=space_modules), \
+                mock.patch('main.get_project_weeks',
+                           return_value=(7, 'times')):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            results = client.post('/api/prices/batch',
+                                  json=scenarios).get_json()['results']
+            rv = client.post('/api/prices/batch', json=scenarios,
+                             headers={'Accept': 'application/x-ndjson'})
+            self.assertEqual(rv.mimetype, 'application/x-ndjson')
+            self.assertEqual([json.loads(line) for line in
+                              rv.get_data(as_text=True).splitlines()], results)
+
+            # The detail is always answered as a whole
+            rv = client.post('/api/prices/detail', json=body,
+                             headers={'Accept': 'application/x-ndjson'})
+            self.assertEqual(rv.mimetype, 'application/json')
+
+    def test_upload_transaction(self):
+        db.create_all()
+        db.session.commit()
+        with app.test_client() as client, \
+                mock.patch('main.write_price_values',
+                           side_effect=Exception('write failed')):
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = self.upload_prices_workbook(client)
+            self.assertEqual(rv.status_code, HTTPStatus.INTERNAL_SERVER_ERROR)
+        # Nothing of the failed upload is kept
+        self.assertEqual(PriceCountry.query.count(), 0)
+        self.assertEqual(PriceModule.query.count(), 0)
+        self.assertEqual(PriceCategory.query.count(), 0)
+
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = self.upload_prices_workbook(client)
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+        diff = rv.get_json()['diff']['CHILE']
+        self.assertEqual(PriceValue.query.count(), diff['inserted'])
+
+    def test_upload_lookups(self):
+        db.create_all()
+        db.session.commit()
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            self.upload_prices_workbook(client)
+            sqlalchemy.event.listen(db.engine, 'before_cursor_execute',
+                                    count_statement)
+            try:
+                rv = self.upload_prices_workbook(client, medium=99)
+            finally:
+                sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                        count_statement)
+        self.assertEqual(rv.get_json()['diff']['CHILE']['changed'], 1)
+        # Modules, categories and values are looked up in indexes loaded once,
+        # not with queries per row
+        rows = PriceValue.query.count()
+        self.assertGreater(rows, 100)
+        self.assertLess(len(statements), 30)
+
+    def test_parallel_sheets(self):
+        workbook = openpyxl.load_workbook('Template_Planilla_Costos.xlsx')
+        workbook.copy_worksheet(workbook['CHILE']).title = 'PERU'
+        workbook['PERU']['F2'] = 99
+        content = BytesIO()
+        workbook.save(content)
+        content = content.getvalue()
+
+        serial = read_workbook_sheets(content, 'openpyxl', parse_prices_sheet,
+                                      PRICE_SHEET_COLUMNS)
+        # Threads stand in for the forked processes of the pool
+        with concurrent.futures.ThreadPoolExecutor(2) as executor, \
+                mock.patch('main._parse_executor', executor), \
+                mock.patch.object(executor, 'submit',
+                                  wraps=executor.submit) as submit:
+            parallel = read_workbook_sheets(
+                content, 'openpyxl', parse_prices_sheet, PRICE_SHEET_COLUMNS)
+            self.assertEqual(submit.call_count, 2)
+        self.assertEqual(list(parallel), ['CHILE', 'PERU'])
+        for sheet_name, sheet in serial.items():
+            pd.testing.assert_frame_equal(parallel[sheet_name], sheet)
+        self.assertFalse(serial['CHILE'].equals(serial['PERU']))
+
+    def test_read_sheet(self):
+        workbook = openpyxl.load_workbook('Template_Planilla_Costos.xlsx')
+        workbook['CHILE'].insert_rows(3)
+        content = BytesIO()
+        workbook.save(content)
+        content = content.getvalue()
+
+        sheet = read_sheet(content, 'CHILE', PRICE_SHEET_COLUMNS)
+        self.assertEqual(list(sheet.columns), PRICE_SHEET_COLUMNS)
+        # The empty row is skipped, rows keep their number in the sheet
+        self.assertEqual(list(sheet.index[:2]), [2, 4])
+        pd.testing.assert_frame_equal(
+            parse_prices_sheet(sheet),
+            parse_prices_sheet(read_excel_sheets(
+                content, 'openpyxl', PRICE_SHEET_COLUMNS)['CHILE']))
+
+    def upload_prices_workbook(self, client, medium=None, query=''):
+        """
+        Upload the prices template, with the ESTANDAR MEDIO of its first
+        price changed to medium if it's given.
+        query: Query string of the upload, e.g. '?dry_run=true'
+        """
+        workbook = openpyxl.load_workbook('Template_Planilla_Costos.xlsx')
+        if medium is not None:
+            workbook['CHILE']['F2'] = medium
+        content = BytesIO()
+        workbook.save(content)
+        files = {'file': (BytesIO(content.getvalue()), 'planilla_excel.xlsx')}
+        return client.post('/api/prices/upload' + query, data=files,
+                           content_type='multipart/form-data')
+
+    def test_partial_upload(self):
+        db.create_all()
+        db.session.commit()
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            self.assertEqual(self.upload_prices_workbook(client).status_code,
+                             HTTPStatus.OK)
+            stored = PriceValue.query.count()
+
+            # A sheet with only some of the rows keeps the other values
+            workbook = openpyxl.load_workbook('Template_Planilla_Costos.xlsx')
+            sheet = workbook['CHILE']
+            sheet.delete_rows(3, sheet.max_row - 2)
+            content = BytesIO()
+            workbook.save(content)
+            rv = client.post('/api/prices/upload', data={
+                'file': (BytesIO(content.getvalue()), 'planilla_excel.xlsx')},
+                content_type='multipart/form-data')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            self.assertEqual(rv.get_json()['diff']['CHILE']['removed'], 0)
+            self.assertEqual(PriceValue.query.count(), stored)
+
+            # Unless it replaces them
+            rv = client.post('/api/prices/upload?replace=true', data={
+                'file': (BytesIO(content.getvalue()), 'planilla_excel.xlsx')},
+                content_type='multipart/form-data')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            removed = rv.get_json()['diff']['CHILE']['removed']
+            self.assertGreater(removed, 0)
+            self.assertEqual(PriceValue.query.count(), stored - removed)
+
+    def test_dry_run_upload(self):
+        db.create_all()
+        db.session.commit()
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            self.upload_prices_workbook(client)
+            values = {value.id: (value.low, value.medium, value.high)
+                      for value in PriceValue.query.all()}
+            version = client.get('/api/prices/versions').get_json()['current']
+
+            rv = self.upload_prices_workbook(client, medium=99,
+                                             query='?dry_run=true')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            self.assertTrue(rv.get_json()['dry_run'])
+            diff = rv.get_json()['diff']['CHILE']
+            self.assertEqual(diff['changed'], 1)
+            self.assertEqual(diff['rows'][0]['new'][1], 99)
+
+            # Nothing was written
+            db.session.expire_all()
+            self.assertEqual({value.id: (value.low, value.medium, value.high)
+                              for value in PriceValue.query.all()}, values)
+            self.assertEqual(
+                client.get('/api/prices/versions').get_json()['current'],
+                version)
+            # nor remembered as applied
+            rv = self.upload_prices_workbook(client, medium=99)
+            self.assertEqual(rv.get_json()['applied'], ['CHILE'])
+
+    def test_upload_job(self):
+        db.create_all()
+        db.session.commit()
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            with open('Template_Planilla_Costos.xlsx', 'rb') as test_file:
+                files = {'file': (BytesIO(test_file.read()), 'planilla.xlsx')}
+            with mock.patch('main._upload_executor') as executor:
+                rv = client.post('/api/prices/upload/jobs', data=files,
+                                 content_type='multipart/form-data')
+            self.assertEqual(rv.status_code, HTTPStatus.ACCEPTED)
+            job_id = rv.get_json()['job_id']
+            rv = client.get(f'/api/prices/upload/jobs/{job_id}')
+            self.assertEqual(rv.get_json()['status'], 'QUEUED')
+
+            # Run the job, as the executor would
+            statuses = []
+
+            def import_workbook(*args):
+                statuses.append(PriceUploadJob.query.get(job_id).status)
+                return import_prices_workbook(*args)
+
+            run_job, *args = executor.submit.call_args.args
+            with mock.patch('main.import_prices_workbook',
+                            side_effect=import_workbook):
+                run_job(*args)
+            self.assertEqual(statuses, ['RUNNING'])
+            job = client.get(f'/api/prices/upload/jobs/{job_id}').get_json()
+            self.assertEqual(job['status'], 'DONE')
+            self.assertEqual(job['sheets_processed'], 1)
+            self.assertGreater(job['rows_processed'], 0)
+            # The stored result leaves out the rows of the diff
+            self.assertNotIn('rows', job['result']['diff']['CHILE'])
+            self.assertGreater(job['result']['diff']['CHILE']['inserted'], 0)
+
+            # A job its worker never finished is failed once it's too old
+            db.session.add(PriceUploadJob(
+                id='lost', filename='planilla.xlsx', status='RUNNING',
+                created_at=dt.datetime.now() - dt.timedelta(days=1)))
+            db.session.commit()
+            job = client.get('/api/prices/upload/jobs/lost').get_json()
+            self.assertEqual(job['status'], 'FAILED')
+
+    def test_upload_hashes(self):
+        db.create_all()
+        db.session.commit()
+
+        def workbook(peru_medium):
+            book = openpyxl.load_workbook('Template_Planilla_Costos.xlsx')
+            book.copy_worksheet(book['CHILE']).title = 'PERU'
+            book['PERU']['F2'] = peru_medium
+            content = BytesIO()
+            book.save(content)
+            return content.getvalue()
+
+        def files(content):
+            return {'file': (BytesIO(content), 'planilla.xlsx')}
+
+        first = workbook(5)
+        second = workbook(6)
+
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = client.post('/api/prices/upload', data=files(first),
+                             content_type='multipart/form-data')
+            self.assertEqual(rv.get_json()['applied'], ['CHILE', 'PERU'])
+            version = client.get('/api/prices/versions').get_json()['current']
+
+            # The same workbook is skipped as a whole
+            with mock.patch('main.read_workbook_sheets') as read_sheets:
+                rv = client.post('/api/prices/upload', data=files(first),
+                                 content_type='multipart/form-data')
+                read_sheets.assert_not_called()
+            self.assertEqual(rv.get_json()['applied'], [])
+            self.assertEqual(rv.get_json()['skipped'], ['CHILE', 'PERU'])
+            self.assertEqual(
+                client.get('/api/prices/versions').get_json()['current'],
+                version)
+
+            # Only the changed sheet is applied
+            rv = client.post('/api/prices/upload', data=files(second),
+                             content_type='multipart/form-data')
+            self.assertEqual(rv.get_json()['applied'], ['PERU'])
+            self.assertEqual(rv.get_json()['skipped'], ['CHILE'])
+
+            rv = client.post('/api/prices/upload?force=true',
+                             data=files(second),
+                             content_type='multipart/form-data')
+            self.assertEqual(rv.get_json()['applied'], ['CHILE', 'PERU'])
+
+    def test_price_versions(self):
+        db.create_all()
+        db.session.commit()
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            rv = self.upload_prices_workbook(client)
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            first = client.get('/api/prices/versions').get_json()['current']
+
+            rv = self.upload_prices_workbook(client, medium=99)
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            self.assertEqual(rv.get_json()['applied'], ['CHILE'])
+            versions = client.get('/api/prices/versions').get_json()
+            self.assertEqual(versions['current'], first + 1)
+            self.assertEqual([v['version'] for v in versions['versions']],
+                             [first + 1, first])
+            self.assertEqual(versions['versions'][0]['countries'], ['CHILE'])
+
+            # Past versions are still priced with the prices they had
+            historic = get_price_matrix('CHILE', first, historic=True)
+            current = get_price_matrix('CHILE', first + 1)
+            self.assertEqual(historic.version, first)
+            self.assertEqual(
+                current.values[historic.values != current.values].tolist(), [99])
+
+            rv = client.post(f'/api/prices/versions/{first}/rollback')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            self.assertEqual(rv.get_json()['version'], first + 2)
+            self.assertEqual(rv.get_json()['countries']['CHILE']['changed'], 1)
+            rolled_back = get_price_matrix('CHILE', first + 2)
+            self.assertTrue(np.array_equal(rolled_back.values, historic.values))
+            self.assertEqual(client.get('/api/prices/versions').get_json()
+                             ['versions'][0]['source'], 'rollback')
+
+            rv = client.post(f'/api/prices/versions/{first + 3}/rollback')
+            self.assertEqual(rv.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_csv_round_trip(self):
+        db.create_all()
+        db.session.commit()
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            self.upload_prices_workbook(client)
+            categories = PriceCategory.query.count()
+
+            rv = client.get('/api/prices/export?format=csv')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            files = {'file': (BytesIO(rv.data), 'precios.csv')}
+            rv = client.post('/api/prices/upload?force=true', data=files,
+                             content_type='multipart/form-data')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            diff = rv.get_json()['diff']['CHILE']
+            self.assertEqual((diff['inserted'], diff['changed'], diff['removed']),
+                             (0, 0, 0))
+            self.assertEqual(PriceCategory.query.count(), categories)
+
+            with open('Template_Costos_Diseño.xlsx', 'rb') as design_file:
+                files = {'file': (BytesIO(design_file.read()), 'diseno.xlsx')}
+            rv = client.post('/api/prices/design/upload', data=files,
+                             content_type='multipart/form-data')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            rv = client.get('/api/prices/export?kind=design&format=csv')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            files = {'file': (BytesIO(rv.data), 'diseno.csv')}
+            rv = client.post('/api/prices/design/upload?force=true', data=files,
+                             content_type='multipart/form-data')
+            self.assertEqual(rv.status_code, HTTPStatus.OK)
+            self.assertIn('ARGENTINA', rv.get_json()['applied'])
+
+    def test_save_price_version(self):
+        db.create_all()
+        db.session.commit()
+        with app.test_client() as client:
+            client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)
+            self.upload_prices_workbook(client)
+            self.upload_prices_workbook(client, medium=99)
+            current = client.get('/api/prices/versions').get_json()['current']
+
+            price_value = PriceValue.query.filter(
+                PriceValue.module_id.isnot(None)).first()
+            category = PriceCategory.query.get(price_value.category_id)
+            body = {
+                'project_id': 1,
+                'value': 100.0,
+                'm2': 50.0,
+                'country': 'CHILE',
+                'workspaces': [{'id': 1, 'space_id': 1, 'quantity': 1}],
+                'categories': [{'id': category.id, 'code': category.code,
+                                'name': category.name, 'type': category.type,
+                                'resp': 'low'}]
+            }
+            downstream_response = mock.Mock(
+                status_code=200, content=b'{}',
+                text=json.dumps({'m2_generated_data': {'workspaces': []}}))
+            with mock.patch('main.downstream') as downstream, \
+                    mock.patch('main.get_spaces_modules',
+                               return_value={1: price_value.module_id}):
+                downstream.get.return_value = downstream_response
+                downstream.put.return_value = downstream_response
+
+                rv = client.post('/api/prices/save', json=body)
+                self.assertEqual(rv.status_code, HTTPStatus.OK)
+                rv = client.get('/api/prices/load/1')
+                self.assertEqual(rv.get_json()['price_version'], current)
+
+                rv = client.post('/api/prices/save',
+                                 json=dict(body, price_version=current - 1))
+                self.assertEqual(rv.status_code, HTTPStatus.OK)
+                rv = client.get('/api/prices/load/1')
+                self.assertEqual(rv.get_json()['price_version'], current - 1)
+
+                rv = client.post('/api/prices/save',
+                                 json=dict(body, price_version=current + 1))
+                self.assertEqual(rv.status_code, HTTPStatus.BAD_REQUEST)
+
     '''def test_get_categories(self):
         with app.test_client() as client:
             client.environ_base['HTTP_AUTHORIZATION'] = self.build_token(self.key)